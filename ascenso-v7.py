@@ -7,11 +7,28 @@ import sqlite3
 import pandas as pd
 from datetime import datetime
 import math # Para cálculos de paginación
+import random
+import threading
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
+from google.api_core import exceptions as google_exceptions
 
 # --- Constante para el archivo de la base de datos ---
 DB_FILE = "basedatos-v7.db"
 
+# --- Constantes del banco de preguntas pre-generadas ---
+POOL_TARGET_SIZE = 40       # Preguntas "vivas" que se intenta mantener por configuración
+POOL_BATCH_SIZE = 10        # Preguntas solicitadas a la IA en cada llamada de reposición
+POOL_MAX_SERVES = 30        # Veces que una pregunta puede servirse antes de retirarla
+POOL_WORKER_INTERVAL = 60   # Segundos entre revisiones del trabajador en segundo plano
+
+# --- Constantes del planificador de llamadas a Gemini ---
+# La cuota de la API es del proyecto: estudiantes y trabajador del banco comparten la misma cubeta.
+GEMINI_REQUESTS_PER_MINUTE = 10
+GEMINI_BURST = 3
+GEMINI_REQUEST_TIMEOUT = 120  # Segundos máximos por petición
+# Errores de transporte (cuota/429 y 5xx): backoff exponencial con jitter.
+GEMINI_TRANSIENT_RETRY_POLICY = {"max_retries": 5, "base_delay": 2.0, "max_delay": 60.0}
+
 # --- Funciones para interactuar con la Base de Datos ---
 
 def init_db():
@@ -50,9 +67,28 @@ def init_db():
         timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
     )
     """)
+    # NUEVO: Banco de preguntas pre-generadas por configuración y registro de lo servido a cada estudiante
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS question_pool (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        config_id INTEGER NOT NULL,
+        question_json TEXT NOT NULL,
+        served_count INTEGER DEFAULT 0,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS pool_draws (
+        student_name TEXT NOT NULL,
+        config_id INTEGER NOT NULL,
+        question_id INTEGER NOT NULL,
+        PRIMARY KEY (student_name, config_id, question_id)
+    )
+    """)
     # Creación de índices para optimizar las consultas del ranking
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_results_profile ON quiz_results (profile_name)")
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_results_grade_time ON quiz_results (grade, timestamp)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pool_config_served ON question_pool (config_id, served_count)")
     conn.commit()
     conn.close()
 
@@ -132,17 +168,26 @@ def save_config_to_db(profile_name, variant_name, asignatura, temas, num_pregunt
         num_preguntas=excluded.num_preguntas,
         dificultad=excluded.dificultad
     """, (profile_name, variant_name, asignatura, temas_json, num_preguntas, dificultad))
+    # Las preguntas del banco se generaron con la configuración anterior: se descartan.
+    cursor.execute("""
+    DELETE FROM question_pool WHERE config_id = (
+        SELECT id FROM quiz_configs WHERE profile_name = ? AND variant_name = ?
+    )
+    """, (profile_name, variant_name))
     conn.commit()
     conn.close()
     get_all_profiles.clear()
     get_variants_for_profile.clear()
     load_config_from_db.clear()
+    wake_pool_worker()
 
 def delete_config_from_db(config_id):
     """Elimina una configuración/variante específica de la DB por su ID."""
     conn = sqlite3.connect(DB_FILE)
     cursor = conn.cursor()
     cursor.execute("DELETE FROM quiz_configs WHERE id = ?", (config_id,))
+    cursor.execute("DELETE FROM question_pool WHERE config_id = ?", (config_id,))
+    cursor.execute("DELETE FROM pool_draws WHERE config_id = ?", (config_id,))
     conn.commit()
     conn.close()
     get_all_profiles.clear()
@@ -188,6 +233,63 @@ def clear_all_results_from_db():
     conn.close()
     get_results_by_profile_as_df.clear()
 
+# --- Funciones del banco de preguntas pre-generadas ---
+
+def get_pool_status():
+    """Devuelve {config_id: preguntas vivas} para todas las configuraciones."""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute("""
+    SELECT c.id, COUNT(q.id)
+    FROM quiz_configs c
+    LEFT JOIN question_pool q ON q.config_id = c.id AND q.served_count < ?
+    GROUP BY c.id
+    """, (POOL_MAX_SERVES,))
+    status = dict(cursor.fetchall())
+    conn.close()
+    return status
+
+def add_questions_to_pool(config_id, questions):
+    """Añade preguntas ya validadas al banco de una configuración."""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    cursor.executemany(
+        "INSERT INTO question_pool (config_id, question_json) VALUES (?, ?)",
+        [(config_id, json.dumps(q)) for q in questions]
+    )
+    conn.commit()
+    conn.close()
+
+def draw_from_pool(config_id, student_name, num_preguntas):
+    """
+    Extrae al azar `num_preguntas` preguntas vivas del banco, priorizando las que el
+    estudiante aún no ha visto. Devuelve None si el banco no tiene suficientes.
+    """
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute("""
+    SELECT q.id, q.question_json
+    FROM question_pool q
+    LEFT JOIN pool_draws d ON d.question_id = q.id AND d.student_name = ? AND d.config_id = q.config_id
+    WHERE q.config_id = ? AND q.served_count < ?
+    ORDER BY (d.question_id IS NOT NULL), RANDOM()
+    LIMIT ?
+    """, (student_name, config_id, POOL_MAX_SERVES, num_preguntas))
+    rows = cursor.fetchall()
+    if len(rows) < num_preguntas:
+        conn.close()
+        return None
+
+    ids = [row[0] for row in rows]
+    cursor.executemany("UPDATE question_pool SET served_count = served_count + 1 WHERE id = ?", [(i,) for i in ids])
+    cursor.executemany(
+        "INSERT OR IGNORE INTO pool_draws (student_name, config_id, question_id) VALUES (?, ?, ?)",
+        [(student_name, config_id, i) for i in ids]
+    )
+    conn.commit()
+    conn.close()
+    return [json.loads(row[1]) for row in rows]
+
 # --- Ejecutar la inicialización de la DB al inicio ---
 init_db()
 
@@ -210,21 +312,22 @@ def reset_quiz_state():
     st.session_state.pagina = 'inicio'
     st.rerun()
 
-# --- INICIO DE LA MODIFICACIÓN ---
-def generar_quiz_con_ia(config, student_name):
-    """
-    Genera un quiz utilizando la IA, con un sistema de reintentos en caso de fallo.
-    """
-    MAX_RETRIES = 3
+SAFETY_SETTINGS = {
+    HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
+    HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
+    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
+}
+
+def construir_prompt(config, num_preguntas, student_name=None):
+    """Construye el prompt del quiz; sin nombre de estudiante se usa para el banco de preguntas."""
     asignatura = config['asignatura']
-    temas_lista = config['temas']
-    num_preguntas = config['num_preguntas']
+    temas_str = ", ".join(config['temas'])
     dificultad = config['dificultad']
-    temas_str = ", ".join(temas_lista)
+    destinatario = f"para el estudiante {student_name}" if student_name else "para estudiantes universitarios"
 
-    prompt = f"""
+    return f"""
     Actúa como un metódico profesor de matemáticas experto en {asignatura} y un excelente pedagogo. 
-    Tu tarea es crear un quiz formativo personalizado de {num_preguntas} preguntas de nivel {dificultad} para el estudiante {student_name}.
+    Tu tarea es crear un quiz formativo personalizado de {num_preguntas} preguntas de nivel {dificultad} {destinatario}.
     El quiz debe enfocarse en la interpretación de conceptos clave y el razonamiento lógico.
     Los temas a cubrir son: {temas_str}.
 
@@ -240,40 +343,127 @@ def generar_quiz_con_ia(config, student_name):
     Cada objeto debe tener las claves: "pregunta", "opciones", "respuesta_correcta", "explicacion".
     La explicación es neutra; debe servir tanto si responde de forma correcta como de forma incorrecta.
     """
-    safety_settings = {
-        HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-        HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-        HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
+
+def parsear_respuesta_quiz(response_text):
+    """Limpia el texto de la IA, lo decodifica y devuelve sólo las preguntas con estructura válida."""
+    json_text = response_text.strip().replace("```json", "").replace("```", "").strip()
+    # Corrección adicional para barras invertidas escapadas incorrectamente
+    json_text = re.sub(r'(?<!\\)\\(?!["\\/bfnrt])', r'\\\\', json_text)
+    quiz_data = json.loads(json_text)
+    if not isinstance(quiz_data, list):
+        return []
+    return [
+        q for q in quiz_data
+        if isinstance(q, dict) and 'pregunta' in q and 'opciones' in q and 'respuesta_correcta' in q
+    ]
+
+# --- PLANIFICADOR DE LLAMADAS A GEMINI ---
+
+GEMINI_TRANSIENT_ERRORS = (
+    google_exceptions.TooManyRequests,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServerError,
+    google_exceptions.DeadlineExceeded,
+)
+
+@st.cache_resource
+def get_gemini_scheduler():
+    """Estado de la cubeta de tokens, compartido por todas las sesiones y el trabajador del proceso."""
+    return {
+        "lock": threading.Lock(),
+        "tokens": float(GEMINI_BURST),
+        "updated_at": time.monotonic(),
+        "paused_until": 0.0,
     }
 
+def acquire_gemini_slot():
+    """Bloquea hasta que la cubeta de tokens (y cualquier pausa por cuota) permita una nueva petición."""
+    scheduler = get_gemini_scheduler()
+    rate_per_second = GEMINI_REQUESTS_PER_MINUTE / 60.0
+    while True:
+        with scheduler["lock"]:
+            now = time.monotonic()
+            elapsed = now - scheduler["updated_at"]
+            scheduler["tokens"] = min(GEMINI_BURST, scheduler["tokens"] + elapsed * rate_per_second)
+            scheduler["updated_at"] = now
+            if now >= scheduler["paused_until"] and scheduler["tokens"] >= 1:
+                scheduler["tokens"] -= 1
+                return
+            wait = max(scheduler["paused_until"] - now, (1 - scheduler["tokens"]) / rate_per_second)
+        time.sleep(wait)
+
+def pause_gemini_scheduler(seconds):
+    """Detiene todas las peticiones del proceso durante `seconds` (p. ej. tras un 429)."""
+    scheduler = get_gemini_scheduler()
+    with scheduler["lock"]:
+        scheduler["paused_until"] = max(scheduler["paused_until"], time.monotonic() + seconds)
+        scheduler["tokens"] = 0.0
+
+def call_gemini(prompt, retry_policy=GEMINI_TRANSIENT_RETRY_POLICY, notificar=True):
+    """
+    Llama a `model.generate_content` respetando el límite de ritmo compartido y con un
+    tiempo máximo por petición. Los errores de cuota, 5xx y tiempo agotado se reintentan
+    con backoff exponencial y jitter; cualquier otro error se propaga al llamador.
+    Desde el hilo del banco se pasa `notificar=False` (no puede mostrar elementos de Streamlit).
+    """
+    policy = retry_policy
+    for attempt in range(policy["max_retries"] + 1):
+        acquire_gemini_slot()
+        try:
+            return model.generate_content(
+                prompt,
+                safety_settings=SAFETY_SETTINGS,
+                request_options={"timeout": GEMINI_REQUEST_TIMEOUT},
+            )
+        except GEMINI_TRANSIENT_ERRORS as e:
+            if attempt == policy["max_retries"]:
+                raise
+            delay = random.uniform(0, min(policy["max_delay"], policy["base_delay"] * 2 ** attempt))
+            if isinstance(e, (google_exceptions.TooManyRequests, google_exceptions.ResourceExhausted)):
+                # La cuota es del proyecto, no de la sesión: se frena a todo el proceso.
+                pause_gemini_scheduler(delay)
+            if notificar:
+                st.toast(f"La API de IA está saturada ({e.code}). Reintentando en {delay:.0f} s...")
+            time.sleep(delay)
+
+# --- INICIO DE LA MODIFICACIÓN ---
+def generar_quiz_con_ia(config, student_name):
+    """
+    Genera un quiz utilizando la IA, con un sistema de reintentos en caso de fallo.
+    Se usa cuando el banco de preguntas de la configuración aún no tiene suficientes.
+    Los errores de cuota y de servidor los reintenta `call_gemini` con backoff; aquí sólo
+    se reintentan de inmediato las respuestas vacías o mal formadas.
+    """
+    MAX_RETRIES = 3
+    num_preguntas = config['num_preguntas']
+    prompt = construir_prompt(config, num_preguntas, student_name)
+
     for attempt in range(MAX_RETRIES):
         try:
-            response = model.generate_content(prompt, safety_settings=safety_settings)
+            response = call_gemini(prompt)
             
             if not response.parts:
                 st.warning(f"Intento {attempt + 1}/{MAX_RETRIES} falló: La IA no devolvió contenido. Reintentando...")
-                time.sleep(1)
                 continue
                 
-            json_text = response.text.strip().replace("```json", "").replace("```", "").strip()
-            # Corrección adicional para barras invertidas escapadas incorrectamente
-            json_text = re.sub(r'(?<!\\)\\(?!["\\/bfnrt])', r'\\\\', json_text)
-            quiz_data = json.loads(json_text)
+            quiz_data = parsear_respuesta_quiz(response.text)
             
             # Validación robusta del contenido generado
-            if isinstance(quiz_data, list) and len(quiz_data) == num_preguntas and all('pregunta' in q and 'opciones' in q and 'respuesta_correcta' in q for q in quiz_data):
+            if len(quiz_data) == num_preguntas:
                 return quiz_data # ¡Éxito! Retornamos el quiz y salimos de la función.
             else:
                 st.warning(f"Intento {attempt + 1}/{MAX_RETRIES} falló: Formato de respuesta inesperado. Reintentando...")
-                time.sleep(1)
 
         except json.JSONDecodeError as e:
             st.warning(f"Intento {attempt + 1}/{MAX_RETRIES} falló: Error al decodificar la respuesta JSON. Reintentando...")
-            time.sleep(1)
+
+        except GEMINI_TRANSIENT_ERRORS as e:
+            # `call_gemini` ya agotó su backoff: insistir sólo alargaría la espera del estudiante.
+            st.error(f"La API de IA sigue saturada ({e.code}). Por favor, inténtalo de nuevo en unos minutos.")
+            return None
 
         except Exception as e:
             st.warning(f"Intento {attempt + 1}/{MAX_RETRIES} falló con un error inesperado: {e}. Reintentando...")
-            time.sleep(1)
 
     # Si el bucle termina sin éxito, mostramos un error final.
     st.error(f"No se pudo generar el quiz después de {MAX_RETRIES} intentos. Por favor, inténtalo de nuevo más tarde.")
@@ -281,6 +471,72 @@ def generar_quiz_con_ia(config, student_name):
 # --- FIN DE LA MODIFICACIÓN ---
 
 
+# --- TRABAJADOR EN SEGUNDO PLANO DEL BANCO DE PREGUNTAS ---
+
+def purge_retired_questions():
+    """Elimina las preguntas que ya alcanzaron `POOL_MAX_SERVES` y su registro de entregas."""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM question_pool WHERE served_count >= ?", (POOL_MAX_SERVES,))
+    cursor.execute("DELETE FROM pool_draws WHERE question_id NOT IN (SELECT id FROM question_pool)")
+    conn.commit()
+    conn.close()
+
+def refill_pools_once(worker):
+    """
+    Repone, lote a lote, cada configuración cuyo banco esté por debajo del objetivo.
+    Cada configuración se procesa por separado: un fallo (cuota agotada, temas mal
+    guardados, respuesta inválida) se anota en `worker["config_errors"]` y no impide
+    reponer las demás.
+    """
+    purge_retired_questions()
+    conn = sqlite3.connect(DB_FILE)
+    conn.row_factory = sqlite3.Row
+    configs = [dict(row) for row in conn.execute("SELECT * FROM quiz_configs")]
+    conn.close()
+
+    status = get_pool_status()
+    config_errors = {}
+    for config in configs:
+        try:
+            config['temas'] = json.loads(config['temas'])
+            while status.get(config['id'], 0) < POOL_TARGET_SIZE:
+                response = call_gemini(construir_prompt(config, POOL_BATCH_SIZE), notificar=False)
+                questions = parsear_respuesta_quiz(response.text) if response.parts else []
+                if not questions:
+                    break
+                add_questions_to_pool(config['id'], questions)
+                status[config['id']] = status.get(config['id'], 0) + len(questions)
+        except Exception as e:
+            config_errors[config['id']] = f"{datetime.now():%Y-%m-%d %H:%M} - {e}"
+    worker["config_errors"] = config_errors
+
+def pool_worker_loop(worker):
+    while True:
+        worker["wake"].clear()
+        try:
+            refill_pools_once(worker)
+            worker["last_error"] = None
+        except Exception as e:
+            # El hilo no puede mostrar elementos de Streamlit; el error se muestra en el panel del profesor.
+            worker["last_error"] = f"{datetime.now():%Y-%m-%d %H:%M} - {e}"
+        worker["wake"].wait(POOL_WORKER_INTERVAL)
+
+@st.cache_resource
+def start_pool_worker():
+    """Arranca (una sola vez por proceso) el hilo que mantiene los bancos de preguntas llenos."""
+    worker = {"wake": threading.Event(), "last_error": None, "config_errors": {}}
+    thread = threading.Thread(target=pool_worker_loop, args=(worker,), daemon=True, name="question-pool-worker")
+    thread.start()
+    return worker
+
+def wake_pool_worker():
+    """Pide al trabajador que revise los bancos de inmediato (tras cambios o consumos)."""
+    start_pool_worker()["wake"].set()
+
+start_pool_worker()
+
+
 # --- FUNCIONES DE INTERFAZ DE ADMINISTRADOR ---
 def check_password():
     st.subheader("Acceso Restringido", divider=True)
@@ -399,6 +655,24 @@ def admin_panel():
                      st.rerun()
 
     with tab_opciones:
+        st.subheader("Banco de Preguntas", divider=True)
+        st.caption(f"Cada unidad mantiene hasta {POOL_TARGET_SIZE} preguntas pre-generadas en segundo plano; cada estudiante recibe un subconjunto al azar priorizando las que no ha visto.")
+        pool_status = get_pool_status()
+        worker = start_pool_worker()
+        config_errors = worker["config_errors"]
+        for profile in get_all_profiles():
+            for variant_id, variant_name in get_variants_for_profile(profile):
+                disponibles = pool_status.get(variant_id, 0)
+                st.progress(min(disponibles / POOL_TARGET_SIZE, 1.0), text=f"{profile} - {variant_name}: {disponibles}/{POOL_TARGET_SIZE} preguntas")
+                if variant_id in config_errors:
+                    st.caption(f":red[Último error al reponer esta unidad: {config_errors[variant_id]}]")
+        worker_error = worker["last_error"]
+        if worker_error:
+            st.warning(f"Último error al reponer el banco: {worker_error}")
+        if st.button("Reponer bancos ahora"):
+            wake_pool_worker()
+            st.toast("Reposición del banco de preguntas solicitada.")
+
         st.subheader("Zona de Peligro", divider=True)
         if st.button("Limpiar TODO el Ranking", type="secondary"):
             st.session_state.confirm_clear_ranking = True
@@ -569,17 +843,21 @@ with tab_examen:
                     config = load_config_from_db(selected_config_id)
                     st.session_state.config_actual_quiz = config 
                     
-                    with st.spinner(f"Generando tu actividad sobre {config['variant_name']}..."):
-                        # MODIFICADO: Pasamos el nombre del estudiante a la función
-                        quiz_data = generar_quiz_con_ia(config, st.session_state.nombre_estudiante)
-                        if quiz_data:
-                            st.session_state.quiz_generado = quiz_data
-                            st.session_state.pagina = 'quiz'
-                            st.session_state.pregunta_actual = 0
-                            st.session_state.respuestas_usuario = {}
-                            st.session_state.puntaje = 0
-                            st.session_state.respuesta_enviada = False
-                            st.rerun()
+                    # Primero se intenta servir desde el banco pre-generado (instantáneo).
+                    quiz_data = draw_from_pool(selected_config_id, st.session_state.nombre_estudiante, config['num_preguntas'])
+                    wake_pool_worker()
+                    if quiz_data is None:
+                        with st.spinner(f"Generando tu actividad sobre {config['variant_name']}..."):
+                            # MODIFICADO: Pasamos el nombre del estudiante a la función
+                            quiz_data = generar_quiz_con_ia(config, st.session_state.nombre_estudiante)
+                    if quiz_data:
+                        st.session_state.quiz_generado = quiz_data
+                        st.session_state.pagina = 'quiz'
+                        st.session_state.pregunta_actual = 0
+                        st.session_state.respuestas_usuario = {}
+                        st.session_state.puntaje = 0
+                        st.session_state.respuesta_enviada = False
+                        st.rerun()
                 else:
                     st.warning("Debes seleccionar un quiz, una versión e ingresar tu nombre para continuar.")
 
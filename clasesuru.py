@@ -1,17 +1,34 @@
 import streamlit as st
+import streamlit.components.v1 as components
 import google.generativeai as genai
 import json
 import time
 import re
 from libsql_client import create_client_sync, Statement
 import pandas as pd
-from datetime import datetime
+from datetime import datetime, timedelta
 import math
 from zoneinfo import ZoneInfo
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
+from google.api_core import exceptions as google_exceptions
 import random
 from streamlit_oauth import OAuth2Component
 import base64
+import os
+import hashlib
+import threading
+import uuid
+import csv
+import tempfile
+import unicodedata
+import itertools
+from collections import OrderedDict, Counter, deque
+
+# Componente propio para resolver la actividad completa en el navegador (ver quiz_component/index.html).
+quiz_client_component = components.declare_component(
+    "quiz_client", path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "quiz_component")
+)
+QUIZ_CLIENT_CHECKPOINT_EVERY = 3  # Respuestas entre guardados de avance en el modo navegador.
 
 # --- INICIALIZACIÓN BÁSICA DEL ESTADO ---
 if 'pagina' not in st.session_state: st.session_state.pagina = 'inicio'
@@ -71,6 +88,10 @@ with st.sidebar:
 
 # --- Constantes para la configuración de IA (sin cambios) ---
 DEFAULT_IA_MODEL = 'models/gemini-3-flash-preview'
+# Modelos (más rápidos) a los que se recurre, en orden, si el principal agota su tiempo o su cuota.
+DEFAULT_IA_FALLBACK_MODELS = ['models/gemini-2.5-flash', 'models/gemini-2.5-flash-lite']
+# Tiempo máximo (segundos) de cada llamada antes de pasar al siguiente modelo de la cadena.
+DEFAULT_IA_ATTEMPT_TIMEOUT = 90
 DEFAULT_IA_PROMPT = """
 ## PERSONA ##
 Actúa como un profesor e investigador universitario experto en {asignatura}.
@@ -82,7 +103,7 @@ Tu única salida debe ser un bloque de código JSON 100% válido. No escribas na
 ## REGLAS DE FORMATO (SEGUIR ESTRICTAMENTE) ##
 
 1.  **SALIDA FINAL:** Una lista de {num_preguntas} objetos JSON.
-2.  **CLAVES DEL OBJETO:** Cada objeto DEBE tener estas 4 claves: "pregunta", "opciones", "respuesta_correcta", "explicacion". Una y sólo una de las opciones debe ser la respuesta correcta.  Asegúrate de que cada párrafo esté separado por un doble espacio (una línea en blanco completa).
+2.  **CLAVES DEL OBJETO:** Cada objeto DEBE tener estas 5 claves: "pregunta", "opciones", "respuesta_correcta", "explicacion", "tema" (el tema de la lista, escrito igual, que evalúa la pregunta). Una y sólo una de las opciones debe ser la respuesta correcta.  Asegúrate de que cada párrafo esté separado por un doble espacio (una línea en blanco completa).
 3.  **ESTRUCTURA DE "pregunta":**
     -   Párrafo 1: Explicación muy breve del concepto. **Palabras clave en negrita**. Incluir enlace `[Más información](URL_YOUTUBE_SEARCH)`.
     -   Párrafo 2: Describe la importancia del concepto. 
@@ -103,13 +124,40 @@ Tu única salida debe ser un bloque de código JSON 100% válido. No escribas na
     "D": "$c=4$ y $c=-4$"
   }},
   "respuesta_correcta": "B",
-  "explicacion": "Un sistema homogéneo tiene soluciones no triviales si el determinante de la matriz de coeficientes es cero. El determinante es $det(A) = (1)(4) - (c)(c) = 4 - c^2$. Igualamos a cero: $4 - c^2 = 0$. Resolvemos para c: $c^2 = 4$, lo que da las soluciones $c=2$ y $c=-2$."
+  "explicacion": "Un sistema homogéneo tiene soluciones no triviales si el determinante de la matriz de coeficientes es cero. El determinante es $det(A) = (1)(4) - (c)(c) = 4 - c^2$. Igualamos a cero: $4 - c^2 = 0$. Resolvemos para c: $c^2 = 4$, lo que da las soluciones $c=2$ y $c=-2$.",
+  "tema": "Determinantes"
 }}
 
 ## INSTRUCCIÓN FINAL Y CRÍTICA ##
 Ahora, genera la lista de {num_preguntas} preguntas. Recuerda, tu respuesta debe ser exclusivamente el código JSON.
 """
 
+# Esquema de salida estructurada: la API de Gemini garantiza JSON válido con esta forma,
+# por lo que la reparación con expresiones regulares queda sólo como respaldo.
+QUIZ_RESPONSE_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {
+            "pregunta": {"type": "STRING"},
+            "opciones": {
+                "type": "OBJECT",
+                "properties": {
+                    "A": {"type": "STRING"},
+                    "B": {"type": "STRING"},
+                    "C": {"type": "STRING"},
+                    "D": {"type": "STRING"},
+                },
+                "required": ["A", "B", "C", "D"],
+            },
+            "respuesta_correcta": {"type": "STRING", "format": "enum", "enum": ["A", "B", "C", "D"]},
+            "explicacion": {"type": "STRING"},
+            "tema": {"type": "STRING"},
+        },
+        "required": ["pregunta", "opciones", "respuesta_correcta", "explicacion", "tema"],
+    },
+}
+
 # --- Funciones para interactuar con la Base de Datos (Turso) ---
 
 @st.cache_resource
@@ -135,6 +183,212 @@ def create_turso_client():
         st.stop()
 
 
+# --- Detección de preguntas casi duplicadas (MinHash + LSH) ---
+
+MINHASH_NUM_PERM = 64
+MINHASH_BANDS = 16                   # 16 bandas de 4 filas: candidatas a partir de ~50% de similitud
+NEAR_DUPLICATE_THRESHOLD = 0.6       # Similitud de Jaccard estimada para marcar una pregunta
+HISTORY_EXCLUSION_LIMIT = 30         # Preguntas anteriores que se envían al prompt como exclusión
+_MINHASH_PRIME = (1 << 61) - 1
+# Semilla fija: las firmas se guardan en la BD y deben ser comparables entre procesos.
+_minhash_rng = random.Random(20240917)
+_MINHASH_PARAMS = [(_minhash_rng.randrange(1, _MINHASH_PRIME), _minhash_rng.randrange(0, _MINHASH_PRIME)) for _ in range(MINHASH_NUM_PERM)]
+
+
+def dividir_parrafos(texto):
+    """Párrafos no vacíos de un texto (en las preguntas: contexto, ..., enunciado)."""
+    return [p.strip() for p in (texto or '').split('\n\n') if p.strip()]
+
+
+def ultimo_parrafo(texto):
+    """Último párrafo no vacío de un texto (en las preguntas, el enunciado en sí)."""
+    partes = dividir_parrafos(texto)
+    return partes[-1] if partes else ''
+
+
+OPTION_PREFIX_RE = re.compile(r'^[A-Z][\)\.]\s*')
+
+
+def opciones_como_dict(opciones):
+    """Devuelve las opciones como diccionario {letra: texto}, aceptando el formato antiguo de lista."""
+    if isinstance(opciones, list):
+        return {chr(65 + i): OPTION_PREFIX_RE.sub('', str(texto)).strip() for i, texto in enumerate(opciones)}
+    return opciones
+
+
+def preprocesar_pregunta(q, estricto=True):
+    """
+    Deja una pregunta lista para mostrarse sin trabajo adicional: opciones como
+    diccionario normalizado, clave de respuesta validada y el enunciado dividido
+    en párrafos. Lanza ValueError si la respuesta no corresponde a ninguna opción,
+    salvo con `estricto=False` (datos históricos), que la conserva tal cual.
+    """
+    opciones = opciones_como_dict(q.get('opciones', {}))
+    respuesta = str(q.get('respuesta_correcta', '')).strip().upper()
+    if respuesta not in opciones and estricto:
+        raise ValueError(f"La respuesta correcta '{respuesta}' no corresponde a ninguna opción de: {q.get('pregunta', '')[:80]}")
+    return {
+        "pregunta": q.get('pregunta', ''),
+        "parrafos": dividir_parrafos(q.get('pregunta', '')),
+        "opciones": opciones,
+        "respuesta_correcta": respuesta,
+        "explicacion": q.get('explicacion', ''),
+        "tema": q.get('tema', ''),
+    }
+
+
+def question_shingles(q):
+    """Tríos de palabras del enunciado y las opciones, normalizados (sin acentos, enlaces ni formato)."""
+    opciones = q.get('opciones', {})
+    opciones_texto = opciones.values() if isinstance(opciones, dict) else opciones
+    texto = " ".join([ultimo_parrafo(q.get('pregunta', ''))] + sorted(str(o) for o in opciones_texto)).lower()
+    texto = re.sub(r'\[([^\]]*)\]\([^)]*\)', r'\1', texto)
+    texto = "".join(c for c in unicodedata.normalize('NFKD', texto) if not unicodedata.combining(c))
+    tokens = re.findall(r'\w+|[=+\-*/^<>]', texto)
+    if len(tokens) < 3:
+        return {" ".join(tokens)} if tokens else set()
+    return {" ".join(tokens[i:i + 3]) for i in range(len(tokens) - 2)}
+
+
+def minhash_signature(q):
+    """Firma MinHash de la pregunta (lista de enteros) o None si no tiene texto."""
+    shingles = question_shingles(q)
+    if not shingles:
+        return None
+    hashes = [int.from_bytes(hashlib.blake2b(sh.encode('utf-8'), digest_size=8).digest(), 'big') for sh in shingles]
+    return [min((a * h + b) % _MINHASH_PRIME for h in hashes) & 0xFFFFFFFF for a, b in _MINHASH_PARAMS]
+
+
+def lsh_band_keys(signature):
+    """Claves LSH por banda: dos preguntas son candidatas si comparten al menos una."""
+    rows = MINHASH_NUM_PERM // MINHASH_BANDS
+    return [
+        f"{band}:" + hashlib.md5(",".join(map(str, signature[band * rows:(band + 1) * rows])).encode()).hexdigest()[:16]
+        for band in range(MINHASH_BANDS)
+    ]
+
+
+def estimated_similarity(sig_a, sig_b):
+    """Similitud de Jaccard estimada a partir de dos firmas MinHash."""
+    return sum(a == b for a, b in zip(sig_a, sig_b)) / MINHASH_NUM_PERM
+
+
+# Índice precalculado de estratos de una versión: {"tema": [ids en orden de posición], ...}
+STRATA_SQL = """(
+    SELECT json_group_object(tema, json(ids)) FROM (
+        SELECT COALESCE(NULLIF(tema, ''), 'general') AS tema, json_group_array(id) AS ids
+        FROM (SELECT id, tema FROM questions WHERE version_id = generated_quizzes.id ORDER BY position)
+        GROUP BY 1
+    )
+)"""
+
+
+# Milisegundos UTC a partir de la fecha en texto ('{col}'); si no se puede interpretar, la hora actual.
+TS_EPOCH_MS_SQL = "CAST(ROUND((COALESCE(julianday({col}), julianday('now')) - 2440587.5) * 86400000) AS INTEGER)"
+
+
+def build_question_statements(config_id, quiz_data, version_id=None, estricto=True):
+    """
+    Sentencias para guardar las preguntas de una versión como filas de 'questions' (ya
+    preprocesadas, con su firma MinHash y sus claves LSH) y registrar en la versión su lista ordenada de IDs. Sin `version_id` se usa la
+    última versión insertada para la configuración (dentro del mismo batch).
+    """
+    if version_id is None:
+        version_sql, version_args = "(SELECT MAX(id) FROM generated_quizzes WHERE config_id = ?)", (config_id,)
+    else:
+        version_sql, version_args = "?", (version_id,)
+
+    statements = []
+    for position, q in enumerate(quiz_data):
+        q = preprocesar_pregunta(q, estricto)
+        signature = minhash_signature(q)
+        statements.append(Statement(
+            f"""INSERT INTO questions (config_id, version_id, position, pregunta, parrafos_json, opciones_json, respuesta_correcta, explicacion, tema, minhash_json)
+                VALUES (?, {version_sql}, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (config_id, *version_args, position, q['pregunta'], json.dumps(q['parrafos']), json.dumps(q['opciones']), q['respuesta_correcta'], q['explicacion'], q['tema'], json.dumps(signature))
+        ))
+        if signature:
+            statements.append(Statement(
+                f"""INSERT INTO question_lsh (config_id, band_key, question_id)
+                    SELECT ?, value, (SELECT id FROM questions WHERE version_id = {version_sql} AND position = ?) FROM json_each(?)""",
+                (config_id, *version_args, position, json.dumps(lsh_band_keys(signature)))
+            ))
+    statements.append(Statement(
+        f"""UPDATE generated_quizzes SET question_ids_json = (
+                SELECT json_group_array(id) FROM (SELECT id FROM questions WHERE version_id = generated_quizzes.id ORDER BY position)
+            ), strata_json = {STRATA_SQL} WHERE id = {version_sql}""",
+        version_args
+    ))
+    return statements
+
+
+def question_from_row(row, columns):
+    """Convierte una fila de 'questions' en el diccionario de pregunta que usa la interfaz."""
+    data = {col: row[idx] for idx, col in enumerate(columns)}
+    return {
+        "id": data['id'],
+        "pregunta": data['pregunta'],
+        "opciones": json.loads(data['opciones_json']),
+        "respuesta_correcta": data['respuesta_correcta'],
+        "explicacion": data['explicacion'],
+        "tema": data.get('tema') or '',
+        "parrafos": json.loads(data['parrafos_json']) if data.get('parrafos_json') else dividir_parrafos(data['pregunta']),
+    }
+
+
+class SharedQuestion:
+    """
+    Pregunta de sólo lectura compartida entre sesiones (vía st.cache_resource).
+    Las opciones se guardan como tuplas paralelas de claves y textos, de modo que
+    cada intento las reordena con una tupla de índices sin copiar la pregunta.
+    `enunciado` es el último párrafo, que se muestra solo cuando no hay retroalimentación.
+    """
+    __slots__ = ('id', 'pregunta', 'enunciado', 'option_keys', 'option_texts', 'respuesta_correcta', 'explicacion', 'tema')
+
+    def __init__(self, question):
+        opciones = question['opciones']
+        parrafos = question['parrafos']
+        for name, value in (
+            ('id', question['id']),
+            ('pregunta', question['pregunta']),
+            ('enunciado', parrafos[-1] if parrafos else question['pregunta']),
+            ('option_keys', tuple(opciones.keys())),
+            ('option_texts', tuple(opciones.values())),
+            ('respuesta_correcta', question['respuesta_correcta']),
+            ('explicacion', question['explicacion']),
+            ('tema', question.get('tema') or ''),
+        ):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("SharedQuestion es inmutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("SharedQuestion es inmutable")
+
+
+class SharedQuizVersion:
+    """Versión de quiz inmutable: tupla de preguntas en orden de posición más un índice por ID."""
+    __slots__ = ('version_id', 'questions', '_positions')
+
+    def __init__(self, version_id, questions):
+        object.__setattr__(self, 'version_id', version_id)
+        object.__setattr__(self, 'questions', tuple(questions))
+        object.__setattr__(self, '_positions', {q.id: pos for pos, q in enumerate(self.questions)})
+
+    def __setattr__(self, name, value):
+        raise AttributeError("SharedQuizVersion es inmutable")
+
+    def __getitem__(self, question_id):
+        return self.questions[self._positions[question_id]]
+
+    def __contains__(self, question_id):
+        return question_id in self._positions
+
+    def __len__(self):
+        return len(self.questions)
+
+
 @st.cache_resource
 def init_db():
     """
@@ -154,6 +408,7 @@ def init_db():
                     num_preguntas INTEGER,
                     dificultad TEXT,
                     show_feedback INTEGER DEFAULT 1,
+                    pool_size INTEGER,
                     UNIQUE(profile_name, variant_name)
                 )
             """),
@@ -168,6 +423,7 @@ def init_db():
                     total_questions INTEGER NOT NULL,
                     grade REAL NOT NULL,
                     timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    ts_epoch_ms INTEGER,
                     quiz_snapshot_json TEXT,
                     student_answers_json TEXT
                 )
@@ -178,33 +434,199 @@ def init_db():
                     config_id INTEGER NOT NULL,
                     quiz_data_json TEXT NOT NULL,
                     is_active INTEGER DEFAULT 0,
+                    model_name TEXT,
+                    question_ids_json TEXT,
+                    strata_json TEXT,
+                    variants_json TEXT,
                     created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
                     FOREIGN KEY (config_id) REFERENCES quiz_configs (id) ON DELETE CASCADE
                 )
             """),
+            Statement("""
+                CREATE TABLE IF NOT EXISTS questions (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    config_id INTEGER NOT NULL,
+                    version_id INTEGER NOT NULL,
+                    position INTEGER NOT NULL,
+                    pregunta TEXT NOT NULL,
+                    parrafos_json TEXT,
+                    opciones_json TEXT NOT NULL,
+                    respuesta_correcta TEXT NOT NULL,
+                    explicacion TEXT,
+                    tema TEXT,
+                    minhash_json TEXT,
+                    FOREIGN KEY (version_id) REFERENCES generated_quizzes (id) ON DELETE CASCADE
+                )
+            """),
+            Statement("CREATE INDEX IF NOT EXISTS idx_questions_version ON questions (version_id, position)"),
+            Statement("CREATE INDEX IF NOT EXISTS idx_questions_config ON questions (config_id)"),
+            Statement("""
+                CREATE TABLE IF NOT EXISTS question_lsh (
+                    config_id INTEGER NOT NULL,
+                    band_key TEXT NOT NULL,
+                    question_id INTEGER NOT NULL
+                )
+            """),
+            Statement("CREATE INDEX IF NOT EXISTS idx_question_lsh_band ON question_lsh (config_id, band_key)"),
+            Statement("""
+                CREATE TABLE IF NOT EXISTS generation_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    model_name TEXT NOT NULL,
+                    prompt TEXT NOT NULL,
+                    params_json TEXT,
+                    response_text TEXT NOT NULL,
+                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    last_used_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            """),
+            Statement("CREATE INDEX IF NOT EXISTS idx_generation_cache_used ON generation_cache (last_used_at)"),
+            Statement("""
+                CREATE TABLE IF NOT EXISTS attempts_in_progress (
+                    id TEXT PRIMARY KEY,
+                    student_email TEXT NOT NULL,
+                    config_id INTEGER NOT NULL,
+                    version_id INTEGER NOT NULL,
+                    question_ids_json TEXT NOT NULL,
+                    option_orders_json TEXT NOT NULL,
+                    client_mode INTEGER DEFAULT 0,
+                    config_json TEXT,
+                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            """),
+            Statement("""
+                CREATE TABLE IF NOT EXISTS attempt_progress (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    attempt_id TEXT NOT NULL,
+                    question_idx INTEGER NOT NULL,
+                    answer TEXT
+                )
+            """),
+            Statement("CREATE INDEX IF NOT EXISTS idx_attempts_student ON attempts_in_progress (student_email, created_at)"),
+            Statement("CREATE INDEX IF NOT EXISTS idx_attempt_progress_attempt ON attempt_progress (attempt_id, id)"),
             Statement("CREATE INDEX IF NOT EXISTS idx_quizzes_config_id ON generated_quizzes (config_id)"),
             Statement("CREATE INDEX IF NOT EXISTS idx_quizzes_active ON generated_quizzes (is_active)"),
             Statement("CREATE INDEX IF NOT EXISTS idx_results_profile ON quiz_results (profile_name)"),
             Statement("CREATE INDEX IF NOT EXISTS idx_results_grade_time ON quiz_results (grade, timestamp)"),
+            Statement("""
+                CREATE TABLE IF NOT EXISTS profiles_with_results (
+                    profile_name TEXT PRIMARY KEY,
+                    result_count INTEGER NOT NULL DEFAULT 0
+                )
+            """),
         ]
         client.batch(create_statements)
 
+        # Índice de asignaturas con resultados: lo mantiene un disparador (también para las filas que
+        # inserte una instancia antigua durante un despliegue escalonado); al arrancar se recalcula
+        # desde los resultados para corregir cualquier desajuste previo.
+        client.batch([
+            Statement("""
+                CREATE TRIGGER IF NOT EXISTS trg_results_profile_count AFTER INSERT ON quiz_results
+                BEGIN
+                    INSERT INTO profiles_with_results (profile_name, result_count) VALUES (NEW.profile_name, 1)
+                    ON CONFLICT(profile_name) DO UPDATE SET result_count = result_count + 1;
+                END
+            """),
+            Statement("""
+                INSERT INTO profiles_with_results (profile_name, result_count)
+                SELECT profile_name, COUNT(*) FROM quiz_results WHERE true GROUP BY profile_name
+                ON CONFLICT(profile_name) DO UPDATE SET result_count = excluded.result_count
+            """),
+        ])
+
         rs = client.execute("PRAGMA table_info(quiz_results)")
         columns = [row[1] for row in rs.rows]
 
         migration_statements = []
-        if 'show_feedback' not in [c[1] for c in client.execute("PRAGMA table_info(quiz_configs)").rows]:
+        config_columns = [c[1] for c in client.execute("PRAGMA table_info(quiz_configs)").rows]
+        if 'show_feedback' not in config_columns:
              migration_statements.append(Statement("ALTER TABLE quiz_configs ADD COLUMN show_feedback INTEGER DEFAULT 1"))
+        if 'pool_size' not in config_columns:
+            migration_statements.append(Statement("ALTER TABLE quiz_configs ADD COLUMN pool_size INTEGER"))
         if 'quiz_snapshot_json' not in columns:
             migration_statements.append(Statement("ALTER TABLE quiz_results ADD COLUMN quiz_snapshot_json TEXT"))
         if 'student_answers_json' not in columns:
             migration_statements.append(Statement("ALTER TABLE quiz_results ADD COLUMN student_answers_json TEXT"))
+        if 'ts_epoch_ms' not in columns:
+            migration_statements.append(Statement("ALTER TABLE quiz_results ADD COLUMN ts_epoch_ms INTEGER"))
+        quiz_columns = [c[1] for c in client.execute("PRAGMA table_info(generated_quizzes)").rows]
+        if 'model_name' not in quiz_columns:
+            migration_statements.append(Statement("ALTER TABLE generated_quizzes ADD COLUMN model_name TEXT"))
+        if 'question_ids_json' not in quiz_columns:
+            migration_statements.append(Statement("ALTER TABLE generated_quizzes ADD COLUMN question_ids_json TEXT"))
+        if 'strata_json' not in quiz_columns:
+            migration_statements.append(Statement("ALTER TABLE generated_quizzes ADD COLUMN strata_json TEXT"))
+        if 'variants_json' not in quiz_columns:
+            migration_statements.append(Statement("ALTER TABLE generated_quizzes ADD COLUMN variants_json TEXT"))
+        question_columns = [c[1] for c in client.execute("PRAGMA table_info(questions)").rows]
+        if 'tema' not in question_columns:
+            migration_statements.append(Statement("ALTER TABLE questions ADD COLUMN tema TEXT"))
+        if 'minhash_json' not in question_columns:
+            migration_statements.append(Statement("ALTER TABLE questions ADD COLUMN minhash_json TEXT"))
+        if 'parrafos_json' not in question_columns:
+            migration_statements.append(Statement("ALTER TABLE questions ADD COLUMN parrafos_json TEXT"))
+        attempt_columns = [c[1] for c in client.execute("PRAGMA table_info(attempts_in_progress)").rows]
+        if 'config_json' not in attempt_columns:
+            migration_statements.append(Statement("ALTER TABLE attempts_in_progress ADD COLUMN config_json TEXT"))
 
         if migration_statements:
             st.warning("Detectada una versión antigua de la base de datos. Actualizando esquema...")
             client.batch(migration_statements)
             st.toast("¡Esquema de la base de datos actualizado correctamente! ✅")
 
+        # Fechas como milisegundos UTC (julianday entiende tanto el ISO con zona de Caracas
+        # como el CURRENT_TIMESTAMP en UTC); el índice permite ordenar y filtrar por rango sin parsear texto.
+        # El disparador completa las filas que aún inserte una instancia antigua (sin 'ts_epoch_ms')
+        # durante un despliegue escalonado.
+        client.batch([
+            Statement(f"UPDATE quiz_results SET ts_epoch_ms = {TS_EPOCH_MS_SQL.format(col='timestamp')} WHERE ts_epoch_ms IS NULL"),
+            Statement(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_results_ts_epoch_ms AFTER INSERT ON quiz_results
+                WHEN NEW.ts_epoch_ms IS NULL
+                BEGIN
+                    UPDATE quiz_results SET ts_epoch_ms = {TS_EPOCH_MS_SQL.format(col='NEW.timestamp')} WHERE id = NEW.id;
+                END
+            """),
+            Statement("CREATE INDEX IF NOT EXISTS idx_results_profile_ts ON quiz_results (profile_name, ts_epoch_ms DESC)"),
+            Statement("CREATE INDEX IF NOT EXISTS idx_results_profile_variant_ts ON quiz_results (profile_name, variant_name, ts_epoch_ms DESC)"),
+        ])
+
+        # Las versiones guardadas como un único JSON se descomponen en filas de la tabla 'questions'.
+        legacy_versions = client.execute("SELECT id, config_id, quiz_data_json FROM generated_quizzes WHERE question_ids_json IS NULL").rows
+        if legacy_versions:
+            st.warning(f"Migrando {len(legacy_versions)} versiones de actividades al banco de preguntas...")
+            for version_id, config_id, quiz_data_json in legacy_versions:
+                client.batch(build_question_statements(config_id, json.loads(quiz_data_json), version_id=version_id, estricto=False))
+            st.toast("¡Versiones migradas al banco de preguntas! ✅")
+
+        client.execute(f"UPDATE generated_quizzes SET strata_json = {STRATA_SQL} WHERE strata_json IS NULL")
+
+        # Índice de casi-duplicados para las preguntas que aún no tienen firma MinHash.
+        unsigned = client.execute("SELECT id, config_id, pregunta, opciones_json FROM questions WHERE minhash_json IS NULL").rows
+        for start in range(0, len(unsigned), 100):
+            statements = []
+            for question_id, config_id, pregunta, opciones_json in unsigned[start:start + 100]:
+                signature = minhash_signature({"pregunta": pregunta, "opciones": json.loads(opciones_json)})
+                statements.append(Statement("UPDATE questions SET minhash_json = ? WHERE id = ?", (json.dumps(signature), question_id)))
+                if signature:
+                    statements.append(Statement(
+                        "INSERT INTO question_lsh (config_id, band_key, question_id) SELECT ?, value, ? FROM json_each(?)",
+                        (config_id, question_id, json.dumps(lsh_band_keys(signature)))
+                    ))
+            client.batch(statements)
+
+        # Preprocesado (párrafos, opciones normalizadas, clave validada) de las preguntas guardadas antes de existir.
+        unprocessed = client.execute("SELECT id, pregunta, opciones_json, respuesta_correcta FROM questions WHERE parrafos_json IS NULL").rows
+        for start in range(0, len(unprocessed), 100):
+            statements = []
+            for question_id, pregunta, opciones_json, respuesta_correcta in unprocessed[start:start + 100]:
+                q = preprocesar_pregunta({"pregunta": pregunta, "opciones": json.loads(opciones_json), "respuesta_correcta": respuesta_correcta}, estricto=False)
+                statements.append(Statement(
+                    "UPDATE questions SET parrafos_json = ?, opciones_json = ?, respuesta_correcta = ? WHERE id = ?",
+                    (json.dumps(q['parrafos']), json.dumps(q['opciones']), q['respuesta_correcta'], question_id)
+                ))
+            client.batch(statements)
+
     except Exception as e:
         st.error(f"Error al inicializar o migrar la base de datos: {e}")
 
@@ -272,21 +694,23 @@ def load_config_from_db(config_id):
         return config
     return None
 
-def save_config_to_db(profile_name, variant_name, asignatura, temas, num_preguntas, dificultad, show_feedback):
+def save_config_to_db(profile_name, variant_name, asignatura, temas, num_preguntas, dificultad, show_feedback, pool_size=None):
     """Guarda (inserta o actualiza) una configuración/variante en la DB."""
     client = get_db_client()
     temas_json = json.dumps(temas)
+    pool_size = max(pool_size or num_preguntas, num_preguntas)
     sql = """
-    INSERT INTO quiz_configs (profile_name, variant_name, asignatura, temas, num_preguntas, dificultad, show_feedback)
-    VALUES (?, ?, ?, ?, ?, ?, ?)
+    INSERT INTO quiz_configs (profile_name, variant_name, asignatura, temas, num_preguntas, dificultad, show_feedback, pool_size)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
     ON CONFLICT(profile_name, variant_name) DO UPDATE SET
         asignatura=excluded.asignatura,
         temas=excluded.temas,
         num_preguntas=excluded.num_preguntas,
         dificultad=excluded.dificultad,
-        show_feedback=excluded.show_feedback
+        show_feedback=excluded.show_feedback,
+        pool_size=excluded.pool_size
     """
-    client.execute(sql, (profile_name, variant_name, asignatura, temas_json, num_preguntas, dificultad, int(show_feedback)))
+    client.execute(sql, (profile_name, variant_name, asignatura, temas_json, num_preguntas, dificultad, int(show_feedback), pool_size))
     get_all_profiles.clear()
     get_variants_for_profile.clear()
     load_config_from_db.clear()
@@ -296,47 +720,217 @@ def save_config_to_db(profile_name, variant_name, asignatura, temas, num_pregunt
 def delete_config_from_db(config_id):
     """Elimina una configuración/variante específica de la DB por su ID."""
     client = get_db_client()
-    client.execute("DELETE FROM quiz_configs WHERE id = ?", (config_id,))
+    client.batch([
+        Statement("DELETE FROM question_lsh WHERE config_id = ?", (config_id,)),
+        Statement("DELETE FROM questions WHERE config_id = ?", (config_id,)),
+        Statement("DELETE FROM quiz_configs WHERE id = ?", (config_id,)),
+    ])
     get_all_profiles.clear()
     get_variants_for_profile.clear()
     load_config_from_db.clear()
     get_variants_with_status_for_profile.clear()
     get_configs_for_profile_as_df.clear()
 
-def save_and_activate_quiz(config_id, quiz_data):
-    """Guarda un nuevo quiz en la BD y lo activa, desactivando cualquier otro."""
+def save_and_activate_quiz(config_id, quiz_data, model_name=None):
+    """
+    Guarda un nuevo quiz en la BD y lo activa, desactivando cualquier otro. Registra el modelo que lo generó.
+    Cada pregunta se guarda como una fila de 'questions'; la versión sólo guarda la lista ordenada de IDs.
+    Devuelve True si la versión quedó guardada y activa.
+    """
     client = get_db_client()
-    quiz_data_json = json.dumps(quiz_data)
     
+    try:
+        question_statements = build_question_statements(config_id, quiz_data)
+    except ValueError as e:
+        st.error(f"No se guardó la actividad: {e}")
+        return False
     statements = [
         Statement("UPDATE generated_quizzes SET is_active = 0 WHERE config_id = ?", (config_id,)),
-        Statement("INSERT INTO generated_quizzes (config_id, quiz_data_json, is_active) VALUES (?, ?, 1)", (config_id, quiz_data_json))
+        Statement("INSERT INTO generated_quizzes (config_id, quiz_data_json, is_active, model_name) VALUES (?, '[]', 1, ?)", (config_id, model_name)),
+        *question_statements,
     ]
     try:
         client.batch(statements)
     except Exception as e:
         st.error(f"Error en la base de datos al activar el quiz: {e}")
+        return False
     
-    get_active_quiz_for_config.clear()
+    get_active_quiz_version.clear()
+    get_latest_quiz_for_config.clear()
+    get_recent_questions_for_config.clear()
     get_variants_with_status_for_profile.clear()
+    warm_config_caches(config_id)
+    return True
 
 @st.cache_data(show_spinner=False)
-def get_active_quiz_for_config(config_id):
-    """Obtiene el quiz activo (JSON) para una configuración dada."""
+def get_active_quiz_version(config_id):
+    """Obtiene la versión activa (id, lista ordenada de IDs y estratos por tema) sin cargar las preguntas."""
     client = get_db_client()
-    rs = client.execute("SELECT quiz_data_json FROM generated_quizzes WHERE config_id = ? AND is_active = 1", (config_id,))
+    rs = client.execute("SELECT id, question_ids_json, strata_json FROM generated_quizzes WHERE config_id = ? AND is_active = 1", (config_id,))
     if rs.rows:
-        return json.loads(rs.rows[0][0])
+        version_id, question_ids_json, strata_json = rs.rows[0]
+        return {
+            "version_id": version_id,
+            "question_ids": json.loads(question_ids_json or '[]'),
+            "strata": json.loads(strata_json or '{}'),
+        }
     return None
 
+@st.cache_resource(show_spinner=False, max_entries=64)
+def get_shared_quiz_version(version_id):
+    """
+    Carga una versión completa una sola vez por proceso como SharedQuizVersion.
+    Todas las sesiones comparten el mismo objeto inmutable; las versiones no cambian
+    tras guardarse (editar crea una versión nueva), así que nunca queda obsoleto.
+    """
+    client = get_db_client()
+    rs = client.execute("SELECT * FROM questions WHERE version_id = ? ORDER BY position", (version_id,))
+    return SharedQuizVersion(version_id, (SharedQuestion(question_from_row(row, rs.columns)) for row in rs.rows))
+
+@st.cache_resource(show_spinner=False, max_entries=64)
+def get_attempt_ring(version_id, num_preguntas, show_feedback):
+    """
+    Anillo de variantes de intento precalculadas para una versión: tupla de pares
+    (IDs de preguntas, órdenes de opciones). Se guarda en 'variants_json' junto con los
+    parámetros con que se calculó; si la configuración cambió (número de preguntas o
+    retroalimentación) se recalcula y se vuelve a guardar.
+    """
+    client = get_db_client()
+    rs = client.execute("SELECT strata_json, variants_json FROM generated_quizzes WHERE id = ?", (version_id,))
+    if not rs.rows:
+        return ()
+    strata_json, variants_json = rs.rows[0]
+    stored = json.loads(variants_json) if variants_json else None
+    if stored and stored.get('num_preguntas') == num_preguntas and stored.get('show_feedback') == show_feedback:
+        ring = stored['ring']
+    else:
+        version = get_shared_quiz_version(version_id)
+        ring = build_attempt_ring(json.loads(strata_json or '{}'), version, num_preguntas, show_feedback)
+        try:
+            client.execute(
+                "UPDATE generated_quizzes SET variants_json = ? WHERE id = ?",
+                (json.dumps({"num_preguntas": num_preguntas, "show_feedback": show_feedback, "ring": ring}), version_id)
+            )
+        except Exception as e:
+            st.warning(f"No se pudieron guardar las variantes precalculadas: {e}")
+    # Órdenes guardados como cadenas de dígitos ("2031"); en memoria, tuplas de índices.
+    return tuple(
+        (tuple(variant['q']), tuple(tuple(int(d) for d in order) for order in variant['o']))
+        for variant in ring
+    )
+
+@st.cache_resource(show_spinner=False)
+def get_attempt_ring_cursor():
+    """Contador del proceso para repartir variantes del anillo por turnos (inicio aleatorio)."""
+    return itertools.count(random.randrange(ATTEMPT_RING_SIZE))
+
+def pick_attempt_variant(active_version, num_preguntas, show_feedback):
+    """
+    Devuelve (IDs de preguntas, órdenes de opciones) para un nuevo intento: la siguiente
+    variante del anillo o, si el anillo está vacío (versión sin fila de variantes o aún
+    no calculada), una variante construida al momento con el mismo procedimiento.
+    """
+    ring = get_attempt_ring(active_version['version_id'], num_preguntas, show_feedback)
+    if ring:
+        return ring[next(get_attempt_ring_cursor()) % len(ring)]
+    version = get_shared_quiz_version(active_version['version_id'])
+    # Sin índice por tema se muestrea de la versión completa como un único estrato.
+    strata = active_version['strata'] or {"": active_version['question_ids']}
+    variant = build_attempt_ring(strata, version, num_preguntas, show_feedback, size=1)[0]
+    return tuple(variant['q']), tuple(tuple(int(d) for d in order) for order in variant['o'])
+
+def warm_config_caches(config_id):
+    """
+    Deja en las cachés compartidas todo lo que lee un estudiante al iniciar esta configuración:
+    la configuración, las unidades de su asignatura, la versión activa, sus preguntas y el
+    anillo de variantes (que se calcula aquí si aún no existe).
+    """
+    config = load_config_from_db(config_id)
+    if not config:
+        return
+    get_variants_with_status_for_profile(config['profile_name'])
+    active_version = get_active_quiz_version(config_id)
+    if active_version:
+        get_shared_quiz_version(active_version['version_id'])
+        get_attempt_ring(active_version['version_id'], config['num_preguntas'], int(config.get('show_feedback', 1)))
+
+@st.cache_resource(show_spinner="Preparando las actividades...")
+def warm_up_caches():
+    """
+    Se ejecuta una vez por proceso (tras un despliegue o reinicio): precarga las rutas de
+    lectura de los estudiantes para todas las actividades activas, de modo que el primero
+    en entrar no pague las cachés vacías.
+    """
+    client = get_db_client()
+    active_config_ids = [row[0] for row in client.execute("SELECT config_id FROM generated_quizzes WHERE is_active = 1").rows]
+    get_all_profiles()
+    get_global_message()
+    get_global_setting('quiz_client_mode', '0')
+    for config_id in active_config_ids:
+        warm_config_caches(config_id)
+    return len(active_config_ids)
+
 @st.cache_data(show_spinner=False)
 def get_latest_quiz_for_config(config_id):
-    """Obtiene la última versión de un quiz generado para una configuración."""
+    """Obtiene la última versión de un quiz generado (preguntas y modelo que la produjo) para una configuración."""
     client = get_db_client()
-    rs = client.execute("SELECT quiz_data_json FROM generated_quizzes WHERE config_id = ? ORDER BY created_at DESC LIMIT 1", (config_id,))
-    if rs.rows:
-        return json.loads(rs.rows[0][0])
-    return None
+    rs = client.execute("SELECT id, model_name FROM generated_quizzes WHERE config_id = ? ORDER BY created_at DESC LIMIT 1", (config_id,))
+    if not rs.rows:
+        return None
+    version_id, model_name = rs.rows[0]
+    rs = client.execute("SELECT * FROM questions WHERE version_id = ? ORDER BY position", (version_id,))
+    return {"content": [question_from_row(row, rs.columns) for row in rs.rows], "model_name": model_name}
+
+@st.cache_data(show_spinner=False)
+def get_recent_questions_for_config(config_id, limit=HISTORY_EXCLUSION_LIMIT):
+    """Últimas preguntas distintas guardadas para una configuración (para usarlas como exclusión en el prompt)."""
+    client = get_db_client()
+    query = "SELECT pregunta FROM questions WHERE config_id = ? GROUP BY pregunta ORDER BY MAX(id) DESC LIMIT ?"
+    rs = client.execute(query, (config_id, limit))
+    return [{"pregunta": row[0]} for row in rs.rows]
+
+def find_near_duplicates(config_id, questions):
+    """
+    Busca, para cada pregunta, preguntas casi idénticas ya guardadas en versiones
+    anteriores de la misma configuración. Sólo consulta las filas que comparten
+    alguna banda LSH, por lo que no recorre todo el historial.
+    Devuelve {índice: [{"similaridad": float, "pregunta": str}, ...]}.
+    """
+    signatures = [minhash_signature(q) for q in questions]
+    band_keys = [lsh_band_keys(sig) if sig else [] for sig in signatures]
+    all_keys = sorted({key for keys in band_keys for key in keys})
+    if not all_keys:
+        return {}
+
+    client = get_db_client()
+    placeholders = ", ".join("?" for _ in all_keys)
+    query = f"""
+    SELECT l.band_key, q.id, q.pregunta, q.minhash_json
+    FROM question_lsh l JOIN questions q ON q.id = l.question_id
+    WHERE l.config_id = ? AND l.band_key IN ({placeholders})
+    """
+    rs = client.execute(query, (config_id, *all_keys))
+    candidates_by_key = {}
+    for band_key, question_id, pregunta, minhash_json in rs.rows:
+        candidates_by_key.setdefault(band_key, {})[question_id] = (pregunta, json.loads(minhash_json))
+
+    duplicates = {}
+    for i, (q, sig, keys) in enumerate(zip(questions, signatures, band_keys)):
+        matches = {}
+        for key in keys:
+            for question_id, (pregunta, candidate_sig) in candidates_by_key.get(key, {}).items():
+                if question_id == q.get('id'):
+                    continue
+                similarity = estimated_similarity(sig, candidate_sig)
+                texto = ultimo_parrafo(pregunta)
+                if similarity >= NEAR_DUPLICATE_THRESHOLD and similarity > matches.get(texto, 0):
+                    matches[texto] = similarity
+        if matches:
+            duplicates[i] = [
+                {"similaridad": sim, "pregunta": texto}
+                for texto, sim in sorted(matches.items(), key=lambda item: -item[1])[:3]
+            ]
+    return duplicates
 
 def check_if_any_quiz_exists(config_id):
     """Verifica si existe CUALQUIER quiz (activo o no) para una configuración."""
@@ -360,27 +954,234 @@ def set_quiz_activation_status(config_id, is_active):
     except Exception as e:
         st.error(f"Error en la base de datos al cambiar el estado del quiz: {e}")
     
-    get_active_quiz_for_config.clear()
+    get_active_quiz_version.clear()
     get_variants_with_status_for_profile.clear()
+    warm_config_caches(config_id)
 
 def save_result_to_db(student_name, profile_name, variant_name, score, total_questions, grade, quiz_snapshot, student_answers):
     """Guarda el resultado de un quiz, incluyendo el snapshot y las respuestas."""
     client = get_db_client()
     sql = """
     INSERT INTO quiz_results (
-        student_name, profile_name, variant_name, score, total_questions, grade, timestamp,
+        student_name, profile_name, variant_name, score, total_questions, grade, timestamp, ts_epoch_ms,
         quiz_snapshot_json, student_answers_json
-    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
     """
     now_in_venezuela = datetime.now(ZoneInfo("America/Caracas"))
+    ts_epoch_ms = int(now_in_venezuela.timestamp() * 1000)
     quiz_snapshot_json = json.dumps(quiz_snapshot)
     student_answers_json = json.dumps(student_answers)
 
+    # El disparador trg_results_profile_count registra la asignatura en 'profiles_with_results'.
     client.execute(sql, (
         student_name, profile_name, variant_name, score, total_questions, grade,
-        now_in_venezuela.isoformat(), quiz_snapshot_json, student_answers_json
+        now_in_venezuela.isoformat(), ts_epoch_ms, quiz_snapshot_json, student_answers_json
     ))
-    get_results_by_profile_as_df.clear()
+    mark_results_stale(profile_name)
+    # La lista de asignaturas sólo cambia con la primera participación de una asignatura.
+    if profile_name not in get_profiles_with_results():
+        get_profiles_with_results.clear()
+
+# --- AVANCE DE INTENTOS EN CURSO ---
+PROGRESS_FLUSH_SECONDS = 3     # Intervalo máximo entre escrituras de avance.
+PROGRESS_FLUSH_BATCH = 50      # Sentencias pendientes que fuerzan una escritura inmediata.
+PROGRESS_RESUME_HOURS = 6      # Antigüedad máxima de un intento para ofrecer retomarlo.
+PROGRESS_MAX_RETRIES = 5       # Intentos de escritura de un mismo lote antes de descartarlo.
+PROGRESS_BUFFER_MAX = 5000     # Sentencias en memoria como máximo; las más antiguas se descartan.
+PROGRESS_PURGE_SECONDS = 600   # Intervalo entre limpiezas de intentos abandonados.
+
+def progress_flush_loop(buffer):
+    last_purge = 0.0
+    while True:
+        time.sleep(PROGRESS_FLUSH_SECONDS)
+        if time.monotonic() - last_purge >= PROGRESS_PURGE_SECONDS:
+            last_purge = time.monotonic()
+            queue_progress_statements(purge_abandoned_attempt_statements(), buffer)
+        flush_progress_buffer(buffer)
+
+@st.cache_resource
+def get_progress_buffer():
+    """
+    Búfer del proceso para el avance de los intentos. Las respuestas se acumulan como
+    eventos y un hilo las escribe en un único batch cada PROGRESS_FLUSH_SECONDS, de modo
+    que un salón completo respondiendo (o reconectándose) no genera una escritura por clic.
+    Un lote que falla se reintenta solo ('failed', con su número de intentos) antes de
+    escribir lo que llegó después.
+    """
+    buffer = {
+        "lock": threading.Lock(), "flush_lock": threading.Lock(), "pending": [], "failed": None,
+        "client": get_db_client(), "last_error": None,
+    }
+    thread = threading.Thread(target=progress_flush_loop, args=(buffer,), daemon=True, name="attempt-progress-flush")
+    thread.start()
+    return buffer
+
+def flush_progress_buffer(buffer=None):
+    """
+    Escribe las sentencias pendientes en orden. Un lote que falla se guarda aparte y se
+    reintenta en los ciclos siguientes; tras PROGRESS_MAX_RETRIES intentos se descarta
+    (los intentos afectados los limpia después la purga de abandonados).
+    """
+    buffer = buffer or get_progress_buffer()
+    with buffer["flush_lock"]:
+        if buffer["failed"] is None:
+            with buffer["lock"]:
+                pending, buffer["pending"] = buffer["pending"], []
+            if not pending:
+                return
+            buffer["failed"] = (pending, 0)
+        pending, attempts = buffer["failed"]
+        try:
+            buffer["client"].batch(pending)
+            buffer["failed"] = None
+            buffer["last_error"] = None
+        except Exception as e:
+            # El hilo no puede mostrar elementos de Streamlit; el error se muestra en el panel del profesor.
+            attempts += 1
+            if attempts >= PROGRESS_MAX_RETRIES:
+                buffer["failed"] = None
+                buffer["last_error"] = f"{datetime.now():%Y-%m-%d %H:%M} - {e} (se descartaron {len(pending)} sentencias tras {attempts} intentos)"
+            else:
+                buffer["failed"] = (pending, attempts)
+                buffer["last_error"] = f"{datetime.now():%Y-%m-%d %H:%M} - {e}"
+
+def queue_progress_statements(statements, buffer=None):
+    buffer = buffer or get_progress_buffer()
+    with buffer["lock"]:
+        buffer["pending"].extend(statements)
+        dropped = len(buffer["pending"]) - PROGRESS_BUFFER_MAX
+        if dropped > 0:
+            # Con la base de datos caída el búfer no puede crecer sin límite: se pierde lo más antiguo.
+            del buffer["pending"][:dropped]
+            buffer["last_error"] = f"{datetime.now():%Y-%m-%d %H:%M} - búfer de avance lleno, se descartaron {dropped} sentencias"
+        overflow = len(buffer["pending"]) >= PROGRESS_FLUSH_BATCH
+    if overflow:
+        flush_progress_buffer(buffer)
+
+def discard_attempt_statements(attempt_filter_sql, args):
+    return [
+        Statement(f"DELETE FROM attempt_progress WHERE attempt_id IN (SELECT id FROM attempts_in_progress WHERE {attempt_filter_sql})", args),
+        Statement(f"DELETE FROM attempts_in_progress WHERE {attempt_filter_sql}", args),
+    ]
+
+def purge_abandoned_attempt_statements():
+    """Elimina los intentos que ya no se pueden retomar y el avance que quedó sin intento."""
+    return [
+        *discard_attempt_statements(f"created_at < datetime('now', '-{PROGRESS_RESUME_HOURS} hours')", ()),
+        Statement("DELETE FROM attempt_progress WHERE attempt_id NOT IN (SELECT id FROM attempts_in_progress)"),
+    ]
+
+def config_snapshot(config):
+    """Datos de la configuración que un intento necesita, fijados al iniciarlo (la unidad puede editarse o borrarse después)."""
+    return {
+        "profile_name": config['profile_name'],
+        "variant_name": config['variant_name'],
+        "asignatura": config.get('asignatura'),
+        "show_feedback": int(config.get('show_feedback', 1)),
+    }
+
+def start_attempt_progress(attempt_id, student_email, config_id, version_id, question_ids, option_orders, client_mode, snapshot):
+    """Registra un intento nuevo (descartando los que el estudiante dejó abiertos)."""
+    queue_progress_statements([
+        *discard_attempt_statements("student_email = ?", (student_email,)),
+        Statement(
+            """INSERT INTO attempts_in_progress (id, student_email, config_id, version_id, question_ids_json, option_orders_json, client_mode, config_json)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+            (attempt_id, student_email, config_id, version_id, json.dumps(list(question_ids)), json.dumps([list(o) for o in option_orders]), int(client_mode), json.dumps(snapshot))
+        ),
+    ])
+
+def record_attempt_answer(attempt_id, question_idx, answer):
+    if attempt_id:
+        queue_progress_statements([Statement("INSERT INTO attempt_progress (attempt_id, question_idx, answer) VALUES (?, ?, ?)", (attempt_id, question_idx, answer))])
+
+def close_attempt_progress(attempt_id):
+    """Elimina el avance de un intento terminado o descartado."""
+    if attempt_id:
+        queue_progress_statements(discard_attempt_statements("id = ?", (attempt_id,)))
+
+def get_open_attempt(student_email):
+    """
+    Último intento sin terminar del estudiante (dentro de PROGRESS_RESUME_HOURS), con sus
+    respuestas reconstruidas a partir de los eventos. Una sola consulta por estudiante.
+    """
+    flush_progress_buffer()
+    client = get_db_client()
+    rs = client.execute(f"""
+        SELECT a.id, a.config_id, a.version_id, a.question_ids_json, a.option_orders_json, a.client_mode, a.config_json,
+               (SELECT json_group_array(json_array(question_idx, answer))
+                FROM (SELECT question_idx, answer FROM attempt_progress WHERE attempt_id = a.id ORDER BY id))
+        FROM attempts_in_progress a
+        WHERE a.student_email = ? AND a.created_at >= datetime('now', '-{PROGRESS_RESUME_HOURS} hours')
+        ORDER BY a.created_at DESC LIMIT 1
+    """, (student_email,))
+    if not rs.rows:
+        return None
+    attempt_id, config_id, version_id, question_ids_json, option_orders_json, client_mode, config_json, events_json = rs.rows[0]
+    question_ids = json.loads(question_ids_json)
+    respuestas = [None] * len(question_ids)
+    for question_idx, answer in json.loads(events_json or '[]'):
+        if 0 <= question_idx < len(respuestas):
+            respuestas[question_idx] = answer
+    return {
+        "attempt_id": attempt_id,
+        "config_id": config_id,
+        "version_id": version_id,
+        "question_ids": question_ids,
+        "option_orders": [tuple(o) for o in json.loads(option_orders_json)],
+        "client_mode": bool(client_mode),
+        # Intentos guardados antes de existir la columna: se usa la configuración actual, si sigue existiendo.
+        "config": json.loads(config_json) if config_json else None,
+        "respuestas": respuestas,
+    }
+
+# --- ADMISIÓN DE INICIOS SIMULTÁNEOS ---
+# Los fallos de caché idénticos ya se atienden una sola vez: st.cache_data y st.cache_resource
+# bloquean por clave mientras calculan, así que durante una avalancha de "Iniciar Actividad"
+# la base de datos recibe una consulta por configuración/versión y el resto de sesiones espera
+# ese mismo resultado. La fila limita además cuántos inicios se preparan a la vez en el proceso.
+MAX_CONCURRENT_STARTS = 8
+
+@st.cache_resource
+def get_start_admission():
+    """Fila FIFO de inicios de actividad, compartida por todas las sesiones del proceso."""
+    return {"condition": threading.Condition(), "queue": deque(), "active": 0}
+
+def acquire_start_slot(placeholder):
+    """
+    Espera turno para preparar un intento, mostrando en `placeholder` la posición en la fila
+    mientras no haya cupo. Al volver ya no se llama a Streamlit: el cupo queda tomado y el
+    llamador debe liberarlo con release_start_slot() en un `finally` inmediato.
+    """
+    admission = get_start_admission()
+    condition = admission["condition"]
+    ticket = object()
+    with condition:
+        admission["queue"].append(ticket)
+        try:
+            while True:
+                free_slots = MAX_CONCURRENT_STARTS - admission["active"]
+                position = admission["queue"].index(ticket)
+                if position < free_slots:
+                    # Se limpia antes de ocupar el cupo: una llamada a Streamlit puede interrumpirse
+                    # (rerun o desconexión) y el cupo quedaría tomado sin release_start_slot().
+                    placeholder.empty()
+                    break
+                placeholder.info(
+                    f"Hay muchos estudiantes iniciando a la vez. Tu posición en la fila: **{position - free_slots + 1}**. "
+                    "No recargues la página."
+                )
+                condition.wait(timeout=1)
+        finally:
+            # También si la sesión se interrumpe mientras espera (recarga o desconexión).
+            admission["queue"].remove(ticket)
+        admission["active"] += 1
+
+def release_start_slot():
+    admission = get_start_admission()
+    with admission["condition"]:
+        admission["active"] -= 1
+        admission["condition"].notify_all()
 
 @st.cache_data(show_spinner=False)
 def get_configs_for_profile_as_df(profile_name):
@@ -391,24 +1192,376 @@ def get_configs_for_profile_as_df(profile_name):
     df = pd.DataFrame(rs.rows, columns=rs.columns)
     return df
     
-@st.cache_data(show_spinner=False)
-def get_results_by_profile_as_df(profile_name):
-    """Obtiene TODOS los resultados de un perfil padre específico."""
+RESULTS_STORE_MAX_ENTRIES = 32  # Combinaciones (perfil, periodo) en memoria; se descartan las menos usadas.
+
+@st.cache_resource
+def get_results_store():
+    """
+    Resultados por (perfil, periodo) compartidos por el proceso, como LRU. 'marks' cuenta, por
+    perfil, las veces que se pidió actualizar; 'generation' cambia con los borrados (de este
+    proceso o, vía 'db_generation', de cualquier otro) y obliga a recargar todo.
+    """
+    return {"lock": threading.Lock(), "entries": OrderedDict(), "marks": {}, "generation": 0, "db_generation": None}
+
+def sync_results_generation():
+    """
+    Compara la generación guardada en 'global_settings' (la incrementa cada borrado total,
+    desde cualquier réplica) con la última vista; si cambió, invalida los resultados locales.
+    """
     client = get_db_client()
-    query = "SELECT * FROM quiz_results WHERE profile_name = ? ORDER BY timestamp DESC, grade DESC"
-    rs = client.execute(query, (profile_name,))
+    rs = client.execute("SELECT value FROM global_settings WHERE key = 'results_generation'")
+    db_generation = rs.rows[0][0] if rs.rows else None
+    store = get_results_store()
+    with store["lock"]:
+        if db_generation != store["db_generation"]:
+            store["db_generation"] = db_generation
+            store["generation"] += 1
+            store["entries"].clear()
+
+def fetch_results_after(profile_name, since_ms, after_id):
+    """
+    Resultados de un perfil con ID mayor que `after_id` (0 = todos), del más reciente al más
+    antiguo. 'ts_epoch_ms' nunca es NULL: lo completan el backfill de init_db y el disparador
+    trg_results_ts_epoch_ms.
+    """
+    client = get_db_client()
+    query = "SELECT * FROM quiz_results WHERE profile_name = ? AND ts_epoch_ms >= ? AND id > ? ORDER BY ts_epoch_ms DESC, grade DESC"
+    rs = client.execute(query, (profile_name, since_ms or 0, after_id))
     df = pd.DataFrame(rs.rows, columns=rs.columns)
+    df['timestamp'] = pd.to_datetime(df['ts_epoch_ms'], unit='ms', utc=True).dt.tz_convert("America/Caracas")
     return df
 
+def get_results_by_profile_as_df(profile_name, since_ms=None):
+    """
+    Obtiene los resultados de un perfil padre específico (todos, o desde `since_ms`).
+    La primera lectura carga todo; tras mark_results_stale sólo se piden las filas con ID
+    mayor que el último visto y se anteponen al DataFrame guardado (que nunca se modifica:
+    se reemplaza). 'timestamp' se deriva de 'ts_epoch_ms' en hora de Caracas.
+    """
+    store = get_results_store()
+    key = (profile_name, since_ms)
+
+    def read_entry():
+        with store["lock"]:
+            entry = store["entries"].get(key)
+            if entry is not None:
+                store["entries"].move_to_end(key)
+            return entry, store["generation"], store["marks"].get(profile_name, 0)
+
+    entry, generation, mark = read_entry()
+    if entry is not None and entry["generation"] == generation and entry["mark"] == mark:
+        return entry["df"]
+    # Antes de ir a la base de datos se comprueba si otra réplica borró los resultados
+    # (los IDs vuelven a empezar y una lectura incremental no vería las filas nuevas).
+    sync_results_generation()
+    entry, generation, mark = read_entry()
+    if entry is None or entry["generation"] != generation:
+        df = fetch_results_after(profile_name, since_ms, 0)
+    else:
+        new_rows = fetch_results_after(profile_name, since_ms, entry["last_id"])
+        df = pd.concat([new_rows, entry["df"]], ignore_index=True) if not new_rows.empty else entry["df"]
+
+    entry = {"df": df, "last_id": int(df['id'].max()) if not df.empty else 0, "generation": generation, "mark": mark}
+    with store["lock"]:
+        if store["generation"] == generation:
+            store["entries"][key] = entry
+            store["entries"].move_to_end(key)
+            while len(store["entries"]) > RESULTS_STORE_MAX_ENTRIES:
+                store["entries"].popitem(last=False)
+    return df
+
+def mark_results_stale(profile_name=None):
+    """Pide una actualización incremental de un perfil (o de todos) en la próxima lectura."""
+    store = get_results_store()
+    with store["lock"]:
+        profiles = [profile_name] if profile_name else {key[0] for key in store["entries"]}
+        for name in profiles:
+            store["marks"][name] = store["marks"].get(name, 0) + 1
+
+def invalidate_results():
+    """Nueva generación local (tras un borrado total): todas las lecturas vuelven a cargar desde cero."""
+    store = get_results_store()
+    with store["lock"]:
+        store["generation"] += 1
+        store["entries"].clear()
+
+@st.cache_data(show_spinner=False)
+def get_profiles_with_results():
+    """Asignaturas con al menos una participación, leídas del índice 'profiles_with_results'."""
+    client = get_db_client()
+    rs = client.execute("SELECT profile_name FROM profiles_with_results WHERE result_count > 0 ORDER BY profile_name")
+    return [row[0] for row in rs.rows]
+
 def clear_all_results_from_db():
     """Elimina todos los registros de la tabla de resultados."""
     client = get_db_client()
     statements = [
         Statement("DELETE FROM quiz_results"),
-        Statement("DELETE FROM sqlite_sequence WHERE name='quiz_results'")
+        Statement("DELETE FROM sqlite_sequence WHERE name='quiz_results'"),
+        Statement("DELETE FROM profiles_with_results"),
+        # Avisa a las demás réplicas (y procesos) que sus resultados en memoria ya no valen.
+        Statement("""
+            INSERT INTO global_settings (key, value) VALUES ('results_generation', '1')
+            ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1
+        """),
     ]
     client.batch(statements)
-    get_results_by_profile_as_df.clear()
+    invalidate_results()
+    get_profiles_with_results.clear()
+
+# --- EXPORTACIÓN DE RESULTADOS (TRABAJOS EN SEGUNDO PLANO) ---
+EXPORT_CHUNK_SIZE = 1000        # Filas leídas de Turso (y escritas) por bloque.
+EXPORT_STUDENTS_PER_CHUNK = 200 # Estudiantes por bloque en el libro de calificaciones.
+EXPORT_JOBS_MAX = 20            # Trabajos (y archivos temporales) que se conservan por proceso.
+
+# Columnas exportables del registro de intentos: columna SQL -> (encabezado, tipo).
+EXPORT_ATTEMPT_COLUMNS = {
+    "id": ("ID", "int"),
+    "student_name": ("Estudiante", "str"),
+    "variant_name": ("Unidad", "str"),
+    "score": ("Aciertos", "int"),
+    "total_questions": ("Preguntas", "int"),
+    "grade": ("Nota", "float"),
+    "ts_epoch_ms": ("Fecha", "datetime"),
+    "student_answers_json": ("Respuestas (JSON)", "str"),
+    "quiz_snapshot_json": ("Preguntas mostradas (JSON)", "str"),
+}
+EXPORT_FORMATS = {
+    "CSV": (".csv", "text/csv"),
+    "XLSX": (".xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "Parquet": (".parquet", "application/vnd.apache.parquet"),
+}
+GRADE_POLICY_SQL = {
+    "Calificación más alta": "SELECT student_name, variant_name, MAX(grade) FROM filtered GROUP BY student_name, variant_name",
+    "Promedio de calificaciones": "SELECT student_name, variant_name, AVG(grade) FROM filtered GROUP BY student_name, variant_name",
+    "Calificación más reciente": """
+        SELECT student_name, variant_name, grade FROM (
+            SELECT student_name, variant_name, grade,
+                   ROW_NUMBER() OVER (PARTITION BY student_name, variant_name ORDER BY ts_epoch_ms DESC, id DESC) AS rn
+            FROM filtered
+        ) WHERE rn = 1
+    """,
+}
+
+def open_export_writer(fmt, path, headers, types):
+    """
+    Abre un escritor incremental para `fmt`: devuelve (write_rows, close). Las filas llegan con
+    valores crudos; las fechas (epoch en ms) se formatean en hora de Caracas salvo en Parquet,
+    donde se guardan como timestamp. XLSX y Parquet requieren openpyxl y pyarrow.
+    """
+    tz = ZoneInfo("America/Caracas")
+
+    def as_text_row(row):
+        return [
+            datetime.fromtimestamp(v / 1000, tz).strftime('%Y-%m-%d %H:%M:%S') if t == "datetime" and v is not None else v
+            for v, t in zip(row, types)
+        ]
+
+    if fmt == "CSV":
+        f = open(path, "w", newline="", encoding="utf-8")
+        writer = csv.writer(f)
+        writer.writerow(headers)
+        return (lambda rows: writer.writerows(as_text_row(r) for r in rows)), f.close
+
+    if fmt == "XLSX":
+        from openpyxl import Workbook
+        workbook = Workbook(write_only=True)  # Modo de sólo escritura: las filas no se conservan en memoria.
+        sheet = workbook.create_sheet("Datos")
+        sheet.append(headers)
+        def write_rows(rows):
+            for r in rows:
+                sheet.append(as_text_row(r))
+        return write_rows, (lambda: workbook.save(path))
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    arrow_types = {"int": pa.int64(), "float": pa.float64(), "str": pa.string(), "datetime": pa.timestamp("ms", tz="America/Caracas")}
+    schema = pa.schema([(h, arrow_types[t]) for h, t in zip(headers, types)])
+    parquet_writer = pq.ParquetWriter(path, schema)
+    def write_rows(rows):
+        if rows:
+            columns = list(zip(*rows))
+            parquet_writer.write_table(pa.Table.from_arrays([pa.array(c, type=f.type) for c, f in zip(columns, schema)], schema=schema))
+    return write_rows, parquet_writer.close
+
+def stream_attempt_rows(client, spec):
+    """Lee el registro de intentos por bloques (paginación por ID, sin OFFSET)."""
+    select = ", ".join(spec["columns"])
+    last_id = 0
+    while True:
+        rs = client.execute(
+            f"""SELECT id, {select} FROM quiz_results
+                WHERE profile_name = ? AND ts_epoch_ms BETWEEN ? AND ? AND id > ?
+                ORDER BY id LIMIT ?""",
+            (spec["profile_name"], spec["since_ms"], spec["until_ms"], last_id, EXPORT_CHUNK_SIZE)
+        )
+        if not rs.rows:
+            return
+        last_id = rs.rows[-1][0]
+        yield [tuple(row)[1:] for row in rs.rows]
+
+def stream_gradebook_rows(client, spec):
+    """
+    Calcula el libro de calificaciones en Turso por bloques de estudiantes (orden alfabético) y
+    emite una fila por estudiante con una columna por unidad evaluativa.
+    """
+    variants = spec["variants"]
+    placeholders = ", ".join("?" for _ in variants)
+    base_args = (spec["profile_name"], spec["since_ms"], spec["until_ms"], *variants)
+    filtered = f"""
+        WITH filtered AS (
+            SELECT id, student_name, variant_name, grade, ts_epoch_ms FROM quiz_results
+            WHERE profile_name = ? AND ts_epoch_ms BETWEEN ? AND ? AND variant_name IN ({placeholders})
+        )"""
+    last_student = ""
+    while True:
+        students = [row[0] for row in client.execute(
+            f"{filtered} SELECT DISTINCT student_name FROM filtered WHERE student_name > ? ORDER BY student_name LIMIT ?",
+            (*base_args, last_student, EXPORT_STUDENTS_PER_CHUNK)
+        ).rows]
+        if not students:
+            return
+        last_student = students[-1]
+        student_placeholders = ", ".join("?" for _ in students)
+        rs = client.execute(
+            f"""{filtered}, grades AS ({GRADE_POLICY_SQL[spec["policy"]]})
+                SELECT * FROM grades WHERE student_name IN ({student_placeholders})""",
+            (*base_args, *students)
+        )
+        by_student = {student: {} for student in students}
+        for student_name, variant_name, grade in rs.rows:
+            by_student[student_name][variant_name] = grade
+        yield [(student, *(grades.get(v) for v in variants)) for student, grades in by_student.items()]
+
+def run_export_job(job, client, spec):
+    """Cuerpo del hilo de exportación: escribe el archivo por bloques e informa el avance en `job`."""
+    try:
+        if spec["dataset"] == "attempts":
+            headers = [EXPORT_ATTEMPT_COLUMNS[c][0] for c in spec["columns"]]
+            types = [EXPORT_ATTEMPT_COLUMNS[c][1] for c in spec["columns"]]
+            chunks = stream_attempt_rows(client, spec)
+        else:
+            headers = ["Estudiante", *spec["variants"]]
+            types = ["str", *("float" for _ in spec["variants"])]
+            chunks = stream_gradebook_rows(client, spec)
+        write_rows, close = open_export_writer(spec["format"], job["path"], headers, types)
+        try:
+            for rows in chunks:
+                write_rows(rows)
+                job["rows"] += len(rows)
+        finally:
+            close()
+        job["status"] = "done"
+    except Exception as e:
+        # El hilo no puede mostrar elementos de Streamlit; el error se muestra en el panel.
+        job["status"] = "error"
+        job["error"] = str(e)
+        if os.path.exists(job["path"]):
+            os.remove(job["path"])
+
+@st.cache_resource
+def get_export_jobs():
+    """Trabajos de exportación del proceso (id -> estado), con su archivo temporal."""
+    return {"lock": threading.Lock(), "jobs": OrderedDict()}
+
+def start_export_job(spec):
+    """
+    Lanza una exportación en segundo plano y devuelve su ID. Conserva los últimos
+    EXPORT_JOBS_MAX trabajos: se descartan (con su archivo) los terminados más antiguos;
+    los que siguen en curso nunca se descartan.
+    """
+    registry = get_export_jobs()
+    extension, mime = EXPORT_FORMATS[spec["format"]]
+    job_id = uuid.uuid4().hex
+    job = {
+        "status": "running", "rows": 0, "error": None, "mime": mime,
+        "path": os.path.join(tempfile.gettempdir(), f"export_{job_id}{extension}"),
+        "file_name": f"{spec['dataset']}_{spec['profile_name'].replace(' ', '_')}{extension}",
+    }
+    with registry["lock"]:
+        registry["jobs"][job_id] = job
+        finished = [old_id for old_id, old_job in registry["jobs"].items() if old_job["status"] != "running"]
+        for old_id in finished[:max(len(registry["jobs"]) - EXPORT_JOBS_MAX, 0)]:
+            old_job = registry["jobs"].pop(old_id)
+            if os.path.exists(old_job["path"]):
+                os.remove(old_job["path"])
+    threading.Thread(target=run_export_job, args=(job, get_db_client(), spec), daemon=True, name=f"export-{job_id[:8]}").start()
+    return job_id
+
+# --- Caché de generaciones de la IA (memoria local + Turso) ---
+
+GENERATION_CACHE_LOCAL_MAX = 50
+GENERATION_CACHE_DB_MAX = 500
+
+@st.cache_resource
+def get_local_generation_cache():
+    """Caché LRU en memoria, compartida por todas las sesiones del proceso."""
+    return {"lock": threading.Lock(), "entries": OrderedDict()}
+
+def generation_cache_key(model_name, prompt, params):
+    """Clave de contenido: hash de (modelo, prompt renderizado, parámetros de generación)."""
+    payload = json.dumps({"model": model_name, "prompt": prompt, "params": params}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def _remember_local_generation(cache_key, response_text):
+    local_cache = get_local_generation_cache()
+    with local_cache["lock"]:
+        entries = local_cache["entries"]
+        entries[cache_key] = response_text
+        entries.move_to_end(cache_key)
+        while len(entries) > GENERATION_CACHE_LOCAL_MAX:
+            entries.popitem(last=False)
+
+def get_cached_generation(cache_key):
+    """Busca una respuesta en la caché local y, si no está, en Turso. Devuelve None si no existe."""
+    local_cache = get_local_generation_cache()
+    with local_cache["lock"]:
+        if cache_key in local_cache["entries"]:
+            local_cache["entries"].move_to_end(cache_key)
+            return local_cache["entries"][cache_key]
+
+    client = get_db_client()
+    try:
+        rs = client.execute("SELECT response_text FROM generation_cache WHERE cache_key = ?", (cache_key,))
+        if not rs.rows:
+            return None
+        client.execute("UPDATE generation_cache SET last_used_at = CURRENT_TIMESTAMP WHERE cache_key = ?", (cache_key,))
+    except Exception:
+        return None
+    response_text = rs.rows[0][0]
+    _remember_local_generation(cache_key, response_text)
+    return response_text
+
+def save_cached_generation(cache_key, model_name, prompt, params, response_text):
+    """Guarda una respuesta en ambas cachés y recorta Turso a las entradas usadas más recientemente."""
+    _remember_local_generation(cache_key, response_text)
+    client = get_db_client()
+    statements = [
+        Statement("""
+            INSERT INTO generation_cache (cache_key, model_name, prompt, params_json, response_text)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(cache_key) DO UPDATE SET
+                response_text = excluded.response_text,
+                last_used_at = CURRENT_TIMESTAMP
+        """, (cache_key, model_name, prompt, json.dumps(params, sort_keys=True), response_text)),
+        Statement("""
+            DELETE FROM generation_cache WHERE cache_key NOT IN (
+                SELECT cache_key FROM generation_cache ORDER BY last_used_at DESC LIMIT ?
+            )
+        """, (GENERATION_CACHE_DB_MAX,)),
+    ]
+    try:
+        client.batch(statements)
+    except Exception as e:
+        st.warning(f"No se pudo guardar la respuesta en la caché de generaciones: {e}")
+
+def clear_generation_cache():
+    """Vacía la caché de generaciones local y la tabla en Turso."""
+    local_cache = get_local_generation_cache()
+    with local_cache["lock"]:
+        local_cache["entries"].clear()
+    client = get_db_client()
+    client.execute("DELETE FROM generation_cache")
 
 # --- Ejecutar la inicialización de la DB al inicio ---
 init_db()
@@ -424,44 +1577,300 @@ except Exception as e:
     st.stop()
 
 
+# --- PLANIFICADOR DE LLAMADAS A GEMINI (COMPARTIDO POR EL PROCESO) ---
+
+# Cubeta de tokens: ritmo sostenido y ráfaga máxima de peticiones al modelo.
+GEMINI_REQUESTS_PER_MINUTE = 10
+GEMINI_BURST = 3
+
+# Política para errores de transporte (cuota/429 y 5xx): backoff exponencial con jitter.
+GEMINI_TRANSIENT_RETRY_POLICY = {"max_retries": 5, "base_delay": 2.0, "max_delay": 60.0}
+# Política para fallos de contenido (respuesta vacía, JSON inválido, preguntas incompletas):
+# se reintenta de inmediato, esperar no mejora la respuesta del modelo.
+GEMINI_CONTENT_RETRY_POLICY = {"max_retries": 3}
+# Cuando queda un modelo de respaldo en la cadena, no se insiste con el actual.
+GEMINI_FALLBACK_RETRY_POLICY = {"max_retries": 0, "base_delay": 0.0, "max_delay": 0.0}
+
+GEMINI_TRANSIENT_ERRORS = (
+    google_exceptions.TooManyRequests,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServerError,
+)
+
+@st.cache_resource
+def get_gemini_scheduler():
+    """Estado de la cubeta de tokens, compartido por todas las sesiones del proceso."""
+    return {
+        "lock": threading.Lock(),
+        "tokens": float(GEMINI_BURST),
+        "updated_at": time.monotonic(),
+        "paused_until": 0.0,
+    }
+
+def acquire_gemini_slot():
+    """Bloquea hasta que la cubeta de tokens (y cualquier pausa por cuota) permita una nueva petición."""
+    scheduler = get_gemini_scheduler()
+    rate_per_second = GEMINI_REQUESTS_PER_MINUTE / 60.0
+    while True:
+        with scheduler["lock"]:
+            now = time.monotonic()
+            elapsed = now - scheduler["updated_at"]
+            scheduler["tokens"] = min(GEMINI_BURST, scheduler["tokens"] + elapsed * rate_per_second)
+            scheduler["updated_at"] = now
+            if now >= scheduler["paused_until"] and scheduler["tokens"] >= 1:
+                scheduler["tokens"] -= 1
+                return
+            wait = max(scheduler["paused_until"] - now, (1 - scheduler["tokens"]) / rate_per_second)
+        time.sleep(wait)
+
+def pause_gemini_scheduler(seconds):
+    """Detiene todas las peticiones del proceso durante `seconds` (p. ej. tras un 429)."""
+    scheduler = get_gemini_scheduler()
+    with scheduler["lock"]:
+        scheduler["paused_until"] = max(scheduler["paused_until"], time.monotonic() + seconds)
+        scheduler["tokens"] = 0.0
+
+def call_gemini(model, prompt, retry_policy=GEMINI_TRANSIENT_RETRY_POLICY, **kwargs):
+    """
+    Llama a `model.generate_content` respetando el límite de ritmo compartido.
+    Los errores de cuota y 5xx se reintentan con backoff exponencial y jitter;
+    cualquier otro error se propaga al llamador.
+    """
+    policy = retry_policy
+    for attempt in range(policy["max_retries"] + 1):
+        acquire_gemini_slot()
+        try:
+            return model.generate_content(prompt, **kwargs)
+        except GEMINI_TRANSIENT_ERRORS as e:
+            if attempt == policy["max_retries"]:
+                raise
+            delay = random.uniform(0, min(policy["max_delay"], policy["base_delay"] * 2 ** attempt))
+            if isinstance(e, (google_exceptions.TooManyRequests, google_exceptions.ResourceExhausted)):
+                # La cuota es del proyecto, no de la sesión: se frena a todo el proceso.
+                pause_gemini_scheduler(delay)
+            st.toast(f"La API de IA está saturada ({e.code}). Reintentando en {delay:.0f} s...")
+            time.sleep(delay)
+
+
 # --- FUNCIONES AUXILIARES Y DE UI ---
 def reset_quiz_state():
-    keys_to_delete = ['pagina', 'quiz_generado', 'pregunta_actual', 'respuestas_usuario', 'puntaje', 'respuesta_enviada', 'config_actual_quiz', 'results_saved']
+    keys_to_delete = ['pagina', 'attempt_id', 'quiz_version_id', 'quiz_config_id', 'quiz_config_snapshot', 'quiz_question_ids', 'quiz_option_orders', 'quiz_client_mode', 'quiz_client_loaded', 'quiz_client_last_event', 'pregunta_actual', 'respuestas_usuario', 'puntaje', 'respuesta_enviada', 'results_saved', 'open_attempt', 'resume_checked']
     for key in keys_to_delete:
         if key in st.session_state:
             del st.session_state[key]
     st.session_state.pagina = 'inicio'
     st.rerun()
 
+def resume_attempt(open_attempt):
+    """Restaura en la sesión un intento guardado, continuando en la primera pregunta sin responder."""
+    respuestas = open_attempt['respuestas']
+    st.session_state.attempt_id = open_attempt['attempt_id']
+    st.session_state.quiz_version_id = open_attempt['version_id']
+    st.session_state.quiz_config_id = open_attempt['config_id']
+    st.session_state.quiz_config_snapshot = open_attempt['config']
+    st.session_state.quiz_question_ids = open_attempt['question_ids']
+    st.session_state.quiz_option_orders = open_attempt['option_orders']
+    st.session_state.quiz_client_mode = open_attempt['client_mode']
+    st.session_state.respuestas_usuario = respuestas
+    st.session_state.puntaje = sum(
+        1 for i, r in enumerate(respuestas) if r is not None and r == get_attempt_question(i)['respuesta_correcta']
+    )
+    st.session_state.respuesta_enviada = False
+    pendientes = [i for i, r in enumerate(respuestas) if r is None]
+    if pendientes:
+        st.session_state.pregunta_actual = pendientes[0]
+        st.session_state.pagina = 'quiz'
+    else:
+        st.session_state.pregunta_actual = len(respuestas) - 1
+        st.session_state.pagina = 'resultados'
+    st.session_state.open_attempt = None
+
 
-def generar_quiz_con_ia(config):
+def extraer_json_de_respuesta(json_text):
     """
-    Genera un quiz utilizando la IA, cargando el prompt y el modelo desde la configuración
-    global y aplicando un sistema de reintentos.
+    Decodifica el texto devuelto por la IA. Con la salida estructurada el texto ya es
+    JSON válido; si no lo es, se aplica la reparación clásica (extraer la lista y
+    escapar barras invertidas sueltas) antes de volver a intentarlo.
     """
-    prompt_template = get_global_setting('ia_prompt', DEFAULT_IA_PROMPT)
-    model_name = get_global_setting('ia_model', DEFAULT_IA_MODEL)
-
     try:
-        model = genai.GenerativeModel(model_name)
-    except Exception as e:
-        st.error(f"Error al inicializar el modelo de IA '{model_name}': {e}")
-        st.error("Por favor, revisa el nombre del modelo en el Área del Profesor > Opciones Avanzadas.")
+        return json.loads(json_text)
+    except json.JSONDecodeError:
+        pass
+
+    match = re.search(r'\[.*\]', json_text, re.DOTALL)
+    if match:
+        json_text = match.group(0)
+    else:
+        json_text = json_text.replace("```json", "").replace("```", "").strip()
+
+    json_text = re.sub(r'(?<!\\)\\(?!["\\/bfnrt])', r'\\\\', json_text)
+    return json.loads(json_text)
+
+
+OPTION_KEYS = ['A', 'B', 'C', 'D']
+
+
+def validar_pregunta(q):
+    """
+    Valida una pregunta generada por la IA. Devuelve la pregunta normalizada
+    (opciones como diccionario A-D) o None si no es utilizable.
+    """
+    if not isinstance(q, dict):
+        return None
+    if not all(isinstance(q.get(k), str) and q.get(k).strip() for k in ('pregunta', 'respuesta_correcta', 'explicacion')):
+        return None
+
+    opciones = q.get('opciones')
+    if isinstance(opciones, list) and len(opciones) == len(OPTION_KEYS):
+        opciones = {
+            letra: OPTION_PREFIX_RE.sub('', str(texto)).strip()
+            for letra, texto in zip(OPTION_KEYS, opciones)
+        }
+    if not isinstance(opciones, dict) or sorted(opciones.keys()) != OPTION_KEYS:
         return None
+    if not all(isinstance(texto, str) and texto.strip() for texto in opciones.values()):
+        return None
+
+    respuesta = q['respuesta_correcta'].strip().upper()
+    if respuesta not in opciones:
+        return None
+
+    return {
+        "pregunta": q['pregunta'],
+        "opciones": {k: opciones[k] for k in OPTION_KEYS},
+        "respuesta_correcta": respuesta,
+        "explicacion": q['explicacion'],
+        "tema": q['tema'].strip() if isinstance(q.get('tema'), str) else '',
+    }
+
 
-    MAX_RETRIES = 3
-    asignatura = config['asignatura']
-    temas_lista = config['temas']
-    num_preguntas = config['num_preguntas']
-    dificultad = config['dificultad']
-    temas_str = ", ".join(temas_lista)
+def resumen_pregunta(q, max_chars=200):
+    """Devuelve el último párrafo de la pregunta (el enunciado en sí), recortado."""
+    resumen = ultimo_parrafo(q.get('pregunta', ''))
+    return resumen if len(resumen) <= max_chars else resumen[:max_chars] + '...'
 
+
+def construir_prompt_quiz(prompt_template, config, num_preguntas, preguntas_excluidas=None):
+    """
+    Rellena la plantilla del prompt para `num_preguntas` preguntas. Si se indican
+    preguntas a excluir, se añade una instrucción para que la IA no las repita.
+    """
     prompt = prompt_template.format(
-        asignatura=asignatura,
+        asignatura=config['asignatura'],
         num_preguntas=num_preguntas,
-        dificultad=dificultad,
-        temas_str=temas_str
+        dificultad=config['dificultad'],
+        temas_str=", ".join(config['temas'])
     )
+    if preguntas_excluidas:
+        lista = "\n".join(f"- {resumen_pregunta(q)}" for q in preguntas_excluidas)
+        prompt += (
+            "\n## PREGUNTAS YA EXISTENTES (NO REPETIR) ##\n"
+            "Las siguientes preguntas ya forman parte de la actividad. Genera preguntas distintas, "
+            "que no repitan su enunciado ni evalúen exactamente lo mismo:\n"
+            f"{lista}\n"
+        )
+    return prompt
+
+
+def generation_params(use_structured_output):
+    """Parámetros de generación (y parte de la clave de la caché)."""
+    return {
+        "response_mime_type": "application/json" if use_structured_output else None,
+        "response_schema": QUIZ_RESPONSE_SCHEMA if use_structured_output else None,
+    }
+
+
+def get_model_chain():
+    """Lista ordenada de modelos a usar: el principal seguido de los de respaldo, sin repetidos."""
+    primary = get_global_setting('ia_model', DEFAULT_IA_MODEL)
+    try:
+        fallbacks = json.loads(get_global_setting('ia_fallback_models', json.dumps(DEFAULT_IA_FALLBACK_MODELS)))
+    except (TypeError, json.JSONDecodeError):
+        fallbacks = DEFAULT_IA_FALLBACK_MODELS
+    return list(dict.fromkeys(m.strip() for m in [primary] + fallbacks if m and m.strip()))
+
+
+def get_attempt_timeout():
+    """Plazo máximo, en segundos, de cada llamada al modelo."""
+    try:
+        return float(get_global_setting('ia_attempt_timeout', DEFAULT_IA_ATTEMPT_TIMEOUT))
+    except (TypeError, ValueError):
+        return float(DEFAULT_IA_ATTEMPT_TIMEOUT)
+
+
+def merge_model_names(*model_names):
+    """Combina nombres de modelos (posiblemente ya combinados) en una cadena sin repetidos."""
+    names = [n.strip() for value in model_names if value for n in value.split(',') if n.strip()]
+    return ", ".join(dict.fromkeys(names)) or None
+
+
+def solicitar_a_cadena_de_modelos(prompt, model_chain, chain_state, safety_settings, timeout):
+    """
+    Envía el prompt al modelo actual de la cadena. Si la llamada agota el plazo o la
+    cuota y queda un modelo de respaldo, se pasa al siguiente (y se permanece en él
+    para el resto de la generación). Devuelve (respuesta, nombre_del_modelo).
+    """
+    while True:
+        model_name = model_chain[chain_state["model_idx"]]
+        has_fallback = chain_state["model_idx"] + 1 < len(model_chain)
+        use_structured_output = model_name not in chain_state["without_schema"]
+        model = genai.GenerativeModel(model_name)
+        retry_policy = GEMINI_FALLBACK_RETRY_POLICY if has_fallback else GEMINI_TRANSIENT_RETRY_POLICY
+        try:
+            try:
+                response = call_gemini(
+                    model,
+                    prompt,
+                    retry_policy=retry_policy,
+                    safety_settings=safety_settings,
+                    generation_config=genai.GenerationConfig(**generation_params(True)) if use_structured_output else None,
+                    request_options={"timeout": timeout},
+                )
+            except google_exceptions.InvalidArgument as e:
+                if not use_structured_output:
+                    raise
+                # El modelo configurado no soporta response_schema: se usa el prompt en modo texto.
+                st.warning(f"El modelo '{model_name}' no admite salida estructurada ({e}). Se usará el modo de texto.")
+                chain_state["without_schema"].add(model_name)
+                response = call_gemini(model, prompt, retry_policy=retry_policy, safety_settings=safety_settings, request_options={"timeout": timeout})
+            return response, model_name
+        except GEMINI_TRANSIENT_ERRORS as e:
+            if not has_fallback:
+                raise
+            next_model = model_chain[chain_state["model_idx"] + 1]
+            st.warning(f"El modelo '{model_name}' no respondió a tiempo o agotó su cuota ({e}). Cambiando a '{next_model}'...")
+            chain_state["model_idx"] += 1
+
+
+def generar_quiz_con_ia(config, num_preguntas=None, preguntas_excluidas=None, force_fresh=False):
+    """
+    Genera un quiz utilizando la IA, cargando el prompt y la cadena de modelos desde la
+    configuración global y aplicando un sistema de reintentos. Se solicita la salida en
+    modo JSON con un esquema declarado; si el modelo no admite el esquema se recurre al
+    modo de texto. Si un modelo supera el plazo por intento o agota su cuota, se pasa
+    al siguiente de la cadena.
+
+    Cada pregunta se valida por separado: las correctas se conservan y los reintentos
+    solicitan únicamente las que faltan, usando las ya aceptadas como exclusión.
+
+    Las respuestas útiles se guardan en la caché de generaciones; con `force_fresh=True`
+    se ignora la caché y siempre se llama al modelo.
+
+    Devuelve (preguntas, modelos_usados) o (None, None) si no se pudo completar.
+    """
+    prompt_template = get_global_setting('ia_prompt', DEFAULT_IA_PROMPT)
+    model_chain = get_model_chain()
+    if not model_chain:
+        st.error("No hay ningún modelo de IA configurado.")
+        st.error("Por favor, revisa el nombre del modelo en el Área del Profesor > Opciones Avanzadas.")
+        return None, None
+    attempt_timeout = get_attempt_timeout()
+    chain_state = {"model_idx": 0, "without_schema": set()}
+
+    MAX_RETRIES = GEMINI_CONTENT_RETRY_POLICY["max_retries"]
+    if num_preguntas is None:
+        num_preguntas = config.get('pool_size') or config['num_preguntas']
+    preguntas_excluidas = list(preguntas_excluidas or [])
 
     safety_settings = {
         HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
@@ -470,67 +1879,167 @@ def generar_quiz_con_ia(config):
         HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
     }
 
+    preguntas_validas = []
+    modelos_usados = None
+    json_text = ""
+    skip_cache = force_fresh
     for attempt in range(MAX_RETRIES):
+        faltantes = num_preguntas - len(preguntas_validas)
+        prompt = construir_prompt_quiz(prompt_template, config, faltantes, preguntas_excluidas + preguntas_validas)
         try:
-            response = model.generate_content(prompt, safety_settings=safety_settings)
-            if not response.parts:
-                st.warning(f"Intento {attempt + 1}/{MAX_RETRIES} falló: La IA no devolvió contenido. Reintentando...")
-                time.sleep(1)
-                continue
-            
-            json_text = response.text.strip()
-            match = re.search(r'\[.*\]', json_text, re.DOTALL)
-            if match:
-                json_text = match.group(0)
+            cached_text = None
+            model_name = model_chain[chain_state["model_idx"]]
+            if not skip_cache:
+                params = generation_params(model_name not in chain_state["without_schema"])
+                cached_text = get_cached_generation(generation_cache_key(model_name, prompt, params))
+
+            if cached_text is not None:
+                json_text = cached_text
+                st.toast("Respuesta recuperada de la caché de generaciones. ⚡")
             else:
-                json_text = json_text.replace("```json", "").replace("```", "").strip()
-
-            json_text = re.sub(r'(?<!\\)\\(?!["\\/bfnrt])', r'\\\\', json_text)
-            quiz_data = json.loads(json_text)
-
-            if isinstance(quiz_data, list) and len(quiz_data) == num_preguntas and all('pregunta' in q for q in quiz_data):
-                return quiz_data
-            else:
-                st.warning(f"Intento {attempt + 1}/{MAX_RETRIES} falló: El formato JSON es válido pero no cumple la estructura. Reintentando...")
-                time.sleep(1)
+                response, model_name = solicitar_a_cadena_de_modelos(prompt, model_chain, chain_state, safety_settings, attempt_timeout)
+
+                if not response.parts:
+                    st.warning(f"Intento {attempt + 1}/{MAX_RETRIES} falló: La IA no devolvió contenido. Reintentando...")
+                    continue
+
+                json_text = response.text.strip()
+
+            quiz_data = extraer_json_de_respuesta(json_text)
+            if isinstance(quiz_data, dict):
+                quiz_data = [quiz_data]
+            if not isinstance(quiz_data, list):
+                quiz_data = []
+
+            nuevas = [q for q in (validar_pregunta(item) for item in quiz_data) if q]
+            preguntas_validas.extend(nuevas[:faltantes])
+            if nuevas:
+                modelos_usados = merge_model_names(modelos_usados, model_name)
+
+            if cached_text is not None and not nuevas:
+                # Una entrada de caché inservible no debe repetirse en el siguiente intento.
+                skip_cache = True
+            elif cached_text is None and nuevas:
+                params = generation_params(model_name not in chain_state["without_schema"])
+                save_cached_generation(generation_cache_key(model_name, prompt, params), model_name, prompt, params, json_text)
+
+            if len(preguntas_validas) == num_preguntas:
+                return preguntas_validas, modelos_usados
+
+            st.warning(
+                f"Intento {attempt + 1}/{MAX_RETRIES}: se conservaron {len(preguntas_validas)} de {num_preguntas} preguntas válidas. "
+                f"Solicitando sólo las {num_preguntas - len(preguntas_validas)} faltantes..."
+            )
         except json.JSONDecodeError as e:
             st.warning(f"Intento {attempt + 1}/{MAX_RETRIES} falló al decodificar JSON: {e}. Reintentando...")
             st.code(json_text, language="text")
-            time.sleep(1)
+        except GEMINI_TRANSIENT_ERRORS as e:
+            # El planificador ya agotó su backoff y no quedan modelos de respaldo.
+            st.error(f"La API de IA sigue sin responder tras varios reintentos: {e}")
+            return None, None
         except Exception as e:
             st.warning(f"Intento {attempt + 1}/{MAX_RETRIES} falló con un error: {e}. Reintentando...")
-            time.sleep(1)
             
-    st.error(f"No se pudo generar el quiz después de {MAX_RETRIES} intentos.")
-    return None
+    st.error(f"No se pudo generar el quiz después de {MAX_RETRIES} intentos ({len(preguntas_validas)} de {num_preguntas} preguntas válidas).")
+    return None, None
 
-def shuffle_question_options(question_data):
+def presentar_pregunta(question, option_order):
     """
-    Toma los datos de una pregunta, baraja sus opciones y actualiza la clave
-    de la respuesta correcta para que coincida con la nueva posición.
+    Vista de una SharedQuestion con sus opciones en el orden del intento: la opción
+    mostrada como A es la de índice `option_order[0]`, etc. Sólo lee la pregunta compartida.
+    Incluye el enunciado sin contexto y las etiquetas del radio ya formateadas.
     """
-    options = question_data['opciones']
-    correct_key = question_data['respuesta_correcta']
-    correct_text = options[correct_key]
+    display_keys = [chr(65 + i) for i in range(len(option_order))]
+    correcta = ''
+    for display_key, option_idx in zip(display_keys, option_order):
+        if question.option_keys[option_idx] == question.respuesta_correcta:
+            correcta = display_key
+    opciones = {k: question.option_texts[option_idx] for k, option_idx in zip(display_keys, option_order)}
+    return {
+        "pregunta": question.pregunta,
+        "enunciado": question.enunciado,
+        "opciones": opciones,
+        "etiquetas": {k: f"{k}: {texto}" for k, texto in opciones.items()},
+        "respuesta_correcta": correcta,
+        "explicacion": question.explicacion,
+    }
 
-    option_items = list(options.items())
-    random.shuffle(option_items)
 
-    new_options = {}
-    new_correct_key = ''
-    new_keys = ['A', 'B', 'C', 'D']
+def get_attempt_question(idx):
+    """Pregunta idx del intento en curso, construida desde la versión compartida y la permutación de la sesión."""
+    version = get_shared_quiz_version(st.session_state.quiz_version_id)
+    question_id = st.session_state.quiz_question_ids[idx]
+    return presentar_pregunta(version[question_id], st.session_state.quiz_option_orders[idx])
 
-    for i, (original_key, text) in enumerate(option_items):
-        new_key = new_keys[i]
-        new_options[new_key] = text
-        if text == correct_text:
-            new_correct_key = new_key
 
-    shuffled_question = question_data.copy()
-    shuffled_question['opciones'] = new_options
-    shuffled_question['respuesta_correcta'] = new_correct_key
+def sample_stratified(strata, k):
+    """
+    Extrae k IDs de preguntas repartidos proporcionalmente entre los estratos (temas)
+    del índice precalculado de la versión. El coste depende de k y del número de
+    temas, no del tamaño del banco.
+    """
+    total = sum(len(ids) for ids in strata.values())
+    if total <= k:
+        return [qid for ids in strata.values() for qid in ids]
+
+    cuotas = {tema: k * len(ids) / total for tema, ids in strata.items()}
+    asignadas = {tema: int(cuota) for tema, cuota in cuotas.items()}
+    restantes = k - sum(asignadas.values())
+    # Los cupos sobrantes van a los temas con mayor parte fraccionaria (empates al azar).
+    por_fraccion = sorted(strata, key=lambda tema: (cuotas[tema] - asignadas[tema], random.random()), reverse=True)
+    for tema in por_fraccion[:restantes]:
+        asignadas[tema] += 1
+
+    seleccion = []
+    for tema, n in asignadas.items():
+        seleccion.extend(random.sample(strata[tema], min(n, len(strata[tema]))))
+    return seleccion
+
+
+ATTEMPT_RING_SIZE = 12  # Múltiplo de 4: cada pregunta lleva su respuesta en A, B, C y D el mismo número de veces.
 
-    return shuffled_question
+
+def balanced_option_order(question, posicion_correcta):
+    """Orden de opciones (cadena de índices, p. ej. "2031") que coloca la respuesta correcta en `posicion_correcta`."""
+    n = len(question.option_keys)
+    correcta = question.option_keys.index(question.respuesta_correcta) if question.respuesta_correcta in question.option_keys else 0
+    resto = [i for i in range(n) if i != correcta]
+    random.shuffle(resto)
+    resto.insert(posicion_correcta % n, correcta)
+    return "".join(str(i) for i in resto)
+
+
+def build_attempt_ring(strata, version, num_preguntas, show_feedback, size=ATTEMPT_RING_SIZE):
+    """
+    Precalcula `size` variantes de intento (selección estratificada, orden de preguntas
+    y orden de opciones). La posición de la respuesta correcta rota entre variantes y
+    entre preguntas, de modo que el anillo queda equilibrado entre A, B, C y D.
+    """
+    ring = []
+    for v in range(size):
+        question_ids = sample_stratified(strata, num_preguntas)
+        if show_feedback:
+            # Actividad formativa: se respeta el orden pedagógico (los IDs crecen con la posición).
+            question_ids.sort()
+        else:
+            random.shuffle(question_ids)
+        ring.append({
+            "q": question_ids,
+            "o": [balanced_option_order(version[qid], v + i) for i, qid in enumerate(question_ids)],
+        })
+    return ring
+
+
+def audit_answer_positions(ring, version):
+    """Cuenta en qué letra queda la respuesta correcta en todas las variantes de un anillo: {'A': n, ...}."""
+    conteo = Counter()
+    for question_ids, orders in ring:
+        for qid, order in zip(question_ids, orders):
+            question = version[qid]
+            for posicion, option_idx in enumerate(order):
+                if question.option_keys[option_idx] == question.respuesta_correcta:
+                    conteo[chr(65 + posicion)] += 1
+    return conteo
 
 
 # --- FUNCIONES DE INTERFAZ DE ADMINISTRADOR ---
@@ -546,16 +2055,76 @@ def check_password():
         except KeyError: st.error("Contraseña de administrador no configurada.")
 
 
+def clear_review_question_state(i):
+    """Elimina las claves de edición (y la previsualización) de una sola pregunta en revisión."""
+    widget_keys = [f"review_q{i}_{key_part}" for key_part in ['pregunta', 'opcion_A', 'opcion_B', 'opcion_C', 'opcion_D', 'correcta', 'explicacion']]
+    widget_keys.append(f"preview_q{i}_radio")
+    for widget_key in widget_keys:
+        if widget_key in st.session_state:
+            del st.session_state[widget_key]
+
+
 def clear_review_state():
     """Elimina del session_state el quiz en revisión y todas sus claves de edición."""
     if 'quiz_for_review' in st.session_state:
         num_questions = len(st.session_state.quiz_for_review.get('content', []))
         for i in range(num_questions):
-            for key_part in ['pregunta', 'opcion_A', 'opcion_B', 'opcion_C', 'opcion_D', 'correcta', 'explicacion']:
-                widget_key = f"review_q{i}_{key_part}"
-                if widget_key in st.session_state:
-                    del st.session_state[widget_key]
+            clear_review_question_state(i)
         del st.session_state.quiz_for_review
+    st.session_state.pop('regenerate_question_idx', None)
+    st.session_state.pop('replace_duplicates', None)
+
+
+def read_review_question(i, q_data):
+    """Devuelve la pregunta i con los valores editados en el formulario (o los originales si aún no existen)."""
+    return {
+        "pregunta": st.session_state.get(f"review_q{i}_pregunta", q_data['pregunta']),
+        "opciones": {k: st.session_state.get(f"review_q{i}_opcion_{k}", q_data['opciones'].get(k, "")) for k in OPTION_KEYS},
+        "respuesta_correcta": st.session_state.get(f"review_q{i}_correcta", q_data['respuesta_correcta']),
+        "explicacion": st.session_state.get(f"review_q{i}_explicacion", q_data['explicacion']),
+        "tema": q_data.get('tema', ''),
+    }
+
+
+def regenerate_review_question(review_data, i):
+    """
+    Regenera con IA sólo la pregunta i del quiz en revisión, usando el resto de
+    preguntas (con sus ediciones) y las versiones anteriores como contexto de exclusión.
+    """
+    config = load_config_from_db(review_data['config_id'])
+    if not config:
+        st.error("No se encontró la configuración de esta actividad.")
+        return
+    if replace_review_questions(review_data, config, [i]):
+        st.toast(f"Pregunta {i+1} regenerada. 🔄")
+
+
+def replace_review_questions(review_data, config, indices):
+    """
+    Sustituye las preguntas `indices` del quiz en revisión con una sola llamada a la IA.
+    Se excluyen el resto de preguntas, las versiones anteriores marcadas como casi
+    duplicadas y el historial reciente; las nuevas preguntas se vuelven a comprobar.
+    """
+    if not indices:
+        return False
+    quiz_content = review_data['content']
+    duplicates = review_data.setdefault('duplicates', {})
+    otras_preguntas = [read_review_question(j, q) for j, q in enumerate(quiz_content) if j not in indices]
+    exclusiones_historicas = [{"pregunta": m["pregunta"]} for i in indices for m in duplicates.get(i, [])]
+    exclusiones_historicas += get_recent_questions_for_config(review_data['config_id'])
+    nuevas, model_name = generar_quiz_con_ia(config, num_preguntas=len(indices), preguntas_excluidas=otras_preguntas + exclusiones_historicas, force_fresh=True)
+    if not nuevas:
+        return False
+    nuevos_duplicados = find_near_duplicates(review_data['config_id'], nuevas)
+    for offset, i in enumerate(indices):
+        quiz_content[i] = nuevas[offset]
+        clear_review_question_state(i)
+        if offset in nuevos_duplicados:
+            duplicates[i] = nuevos_duplicados[offset]
+        else:
+            duplicates.pop(i, None)
+    review_data['model_name'] = merge_model_names(review_data.get('model_name'), model_name)
+    return True
 
 
 def admin_panel():
@@ -598,7 +2167,7 @@ def admin_panel():
                 profile_name_input = st.text_input("Nombre nueva asignatura", placeholder="Asignatura nueva")
             with coll2:
                 variant_name_input = st.text_input("Unidad de aprendizaje", placeholder="#1: Nombre del tema general")
-            config_data = {'asignatura': '', 'temas': [], 'num_preguntas': 7, 'dificultad': 'fácil/intermedio', 'show_feedback': 1}
+            config_data = {'asignatura': '', 'temas': [], 'num_preguntas': 7, 'pool_size': 7, 'dificultad': 'fácil/intermedio', 'show_feedback': 1}
         else:
             profile_name_input = selected_parent_profile
             st.subheader(f"Gestionar unidades de: {selected_parent_profile}")
@@ -617,7 +2186,7 @@ def admin_panel():
             
             if selected_config_id == create_variant_option_id:
                 variant_name_input = st.text_input("Nombre de la Nueva Unidad:")
-                config_data = {'asignatura': '', 'temas': [], 'num_preguntas': 7, 'dificultad': 'fácil/intermedio', 'show_feedback': 1}
+                config_data = {'asignatura': '', 'temas': [], 'num_preguntas': 7, 'pool_size': 7, 'dificultad': 'fácil/intermedio', 'show_feedback': 1}
             else:
                 config_data = load_config_from_db(selected_config_id)
                 variant_name_input = config_data.get('variant_name', '')
@@ -625,13 +2194,17 @@ def admin_panel():
         with st.form("admin_form"):
             asignatura = st.text_input("Nombre completo de la asignatura", value=config_data.get('asignatura', ''))
             temas_input = st.text_area("Temas (separados por comas)", value=", ".join(config_data.get('temas', [])), height=100)
-            c1, c2 = st.columns(2)
+            c1, c2, c3 = st.columns(3)
             num_preguntas = c1.number_input("Nº de preguntas", 3, 12, config_data.get('num_preguntas', 7))
+            pool_size = c2.number_input(
+                "Tamaño del banco", 3, 60, config_data.get('pool_size') or config_data.get('num_preguntas', 7),
+                help="Preguntas que se generan por versión. Cada intento toma 'Nº de preguntas' de este banco, repartidas por tema, así cada estudiante recibe una combinación distinta sin regenerar."
+            )
             dificultad_options = ["fácil/intermedio", "intermedio/avanzado", "avanzado/difícil"]
             try:
                 current_dificultad_index = dificultad_options.index(config_data.get('dificultad', 'fácil/intermedio'))
             except ValueError: current_dificultad_index = 1
-            dificultad = c2.selectbox("Dificultad", dificultad_options, index=current_dificultad_index)
+            dificultad = c3.selectbox("Dificultad", dificultad_options, index=current_dificultad_index)
             
             show_feedback_toggle = st.toggle(
                 "Mostrar retroalimentación inmediata",
@@ -645,7 +2218,7 @@ def admin_panel():
                     st.error("El nombre de la asignatura y de la unidad no pueden estar vacíos.")
                 else:
                     temas_lista = [t.strip() for t in temas_input.split(',') if t.strip()]
-                    save_config_to_db(profile_name_input, variant_name_input, asignatura, temas_lista, num_preguntas, dificultad, show_feedback_toggle)
+                    save_config_to_db(profile_name_input, variant_name_input, asignatura, temas_lista, num_preguntas, dificultad, show_feedback_toggle, pool_size)
                     st.toast(f"¡Configuración '{profile_name_input} - {variant_name_input}' guardada! ✅", icon="✅")
                     st.rerun()
 
@@ -670,14 +2243,36 @@ def admin_panel():
         if 'quiz_for_review' in st.session_state:
             review_data = st.session_state.quiz_for_review
             st.subheader("Previsualización y Edición de la Actividad", divider='rainbow')
-            st.info("Revisa la actividad generada. Puedes expandir cada pregunta para editarla si es necesario. Cuando termines, aprueba los cambios para que esté disponible para los estudiantes.")
+            st.info("Revisa la actividad generada. Puedes expandir cada pregunta para editarla o regenerarla si es necesario. Cuando termines, aprueba los cambios para que esté disponible para los estudiantes.")
+            if review_data.get('model_name'):
+                st.caption(f"Generada con: `{review_data['model_name']}`")
+
+            if 'regenerate_question_idx' in st.session_state:
+                regen_idx = st.session_state.pop('regenerate_question_idx')
+                with st.spinner(f"Regenerando la pregunta {regen_idx + 1}..."):
+                    regenerate_review_question(review_data, regen_idx)
+
+            if st.session_state.pop('replace_duplicates', False):
+                with st.spinner("Reemplazando preguntas repetidas..."):
+                    replace_review_questions(review_data, load_config_from_db(review_data['config_id']), sorted(review_data.get('duplicates', {})))
+
+            duplicates = review_data.get('duplicates', {})
+            if duplicates:
+                st.warning(f"⚠️ {len(duplicates)} pregunta(s) son muy parecidas a preguntas de versiones anteriores de esta unidad.")
+                if st.button(f"🔁 Reemplazar automáticamente las {len(duplicates)} preguntas repetidas", width='stretch'):
+                    st.session_state.replace_duplicates = True
+                    st.rerun()
 
             with st.form("review_form"):
                 quiz_content = review_data['content']
                 
                 for i, q_data in enumerate(quiz_content):
                     pregunta_resumen = q_data['pregunta'].split('\n\n')[1] if '\n\n' in q_data['pregunta'] else q_data['pregunta']
-                    with st.expander(f"**Pregunta {i+1}:** {pregunta_resumen.strip()}", expanded=i==0):
+                    marca_duplicado = "⚠️ " if i in duplicates else ""
+                    with st.expander(f"{marca_duplicado}**Pregunta {i+1}:** {pregunta_resumen.strip()}", expanded=i==0):
+                        if i in duplicates:
+                            similares = "\n".join(f"- ({m['similaridad']:.0%}) {m['pregunta']}" for m in duplicates[i])
+                            st.warning(f"Muy parecida a preguntas de versiones anteriores:\n{similares}")
                         st.markdown("---")
                         st.markdown("##### Así lo verá el estudiante:")
                         with st.container(border=True):
@@ -703,24 +2298,19 @@ def admin_panel():
                         st.radio(label="**Respuesta Correcta**", options=opciones_keys, index=opciones_keys.index(q_data['respuesta_correcta']) if q_data['respuesta_correcta'] in opciones_keys else 0, key=f"review_q{i}_correcta", horizontal=True)
                         st.text_area(label="Explicación", value=q_data['explicacion'], key=f"review_q{i}_explicacion", height=150)
 
+                        if st.form_submit_button("🔄 Regenerar esta pregunta", key=f"regen_q{i}", help="Genera con IA una nueva pregunta sólo para esta posición, conservando las demás."):
+                            st.session_state.regenerate_question_idx = i
+                            st.rerun()
+
                 submitted = st.form_submit_button("✅ Aprobar y Activar Cambios", type="primary", width='stretch')
                 if submitted:
-                    edited_quiz_content = []
-                    for i in range(len(quiz_content)):
-                        new_q = {
-                            "pregunta": st.session_state[f"review_q{i}_pregunta"],
-                            "opciones": { "A": st.session_state[f"review_q{i}_opcion_A"], "B": st.session_state[f"review_q{i}_opcion_B"], "C": st.session_state[f"review_q{i}_opcion_C"], "D": st.session_state[f"review_q{i}_opcion_D"]},
-                            "respuesta_correcta": st.session_state[f"review_q{i}_correcta"],
-                            "explicacion": st.session_state[f"review_q{i}_explicacion"],
-                        }
-                        edited_quiz_content.append(new_q)
+                    edited_quiz_content = [read_review_question(i, q) for i, q in enumerate(quiz_content)]
                     
                     config_id = review_data['config_id']
-                    save_and_activate_quiz(config_id, edited_quiz_content)
-                    
-                    st.toast("¡Actividad revisada y activada con éxito! ✅", icon="✅")
-                    clear_review_state()
-                    st.rerun()
+                    if save_and_activate_quiz(config_id, edited_quiz_content, review_data.get('model_name')):
+                        st.toast("¡Actividad revisada y activada con éxito! ✅", icon="✅")
+                        clear_review_state()
+                        st.rerun()
 
             if st.button("❌ Descartar y Volver", width='stretch'):
                 clear_review_state()
@@ -734,6 +2324,11 @@ def admin_panel():
             if not profiles:
                 st.warning("Primero debes crear una configuración en la pestaña 'Gestionar Configuraciones'.")
             else:
+                force_fresh = st.toggle(
+                    "Forzar generación nueva (ignorar caché)",
+                    key="force_fresh_generation",
+                    help="Si está desactivado, repetir una generación con la misma configuración, modelo y prompt reutiliza la respuesta guardada sin llamar a la IA."
+                )
                 for profile_name in profiles:
                     st.markdown(f"### {profile_name}")
                     variants = get_variants_for_profile(profile_name)
@@ -743,7 +2338,7 @@ def admin_panel():
                     
                     for config_id, variant_name in variants:
                         with st.container(border=True):
-                            active_quiz = get_active_quiz_for_config(config_id)
+                            active_quiz = get_active_quiz_version(config_id)
                             quiz_has_been_generated = check_if_any_quiz_exists(config_id)
                             
                             col1, col2, col3, col4 = st.columns([2, 1, 1, 1.2])
@@ -752,6 +2347,16 @@ def admin_panel():
                                 st.markdown(f"**{variant_name}**")
                                 if active_quiz:
                                     st.success("✅ Activa")
+                                    active_config = load_config_from_db(config_id)
+                                    ring = get_attempt_ring(active_quiz['version_id'], active_config['num_preguntas'], int(active_config.get('show_feedback', 1)))
+                                    if ring:
+                                        posiciones = audit_answer_positions(ring, get_shared_quiz_version(active_quiz['version_id']))
+                                        st.caption(
+                                            f"{len(ring)} variantes precalculadas · respuestas correctas por letra: "
+                                            + ", ".join(f"{letra} {posiciones.get(letra, 0)}" for letra in "ABCD")
+                                        )
+                                    else:
+                                        st.caption("Sin variantes precalculadas: cada intento se arma al iniciarlo.")
                                 else:
                                     st.warning("⚠️ Inactiva")
 
@@ -759,22 +2364,27 @@ def admin_panel():
                                 if st.button("Generar", key=f"gen_{config_id}", width='stretch', help="Crea una nueva versión con IA para revisarla y activarla."):
                                     config = load_config_from_db(config_id)
                                     with st.spinner(f"Generando ..."):
-                                        quiz_content = generar_quiz_con_ia(config)
+                                        quiz_content, model_name = generar_quiz_con_ia(
+                                            config, preguntas_excluidas=get_recent_questions_for_config(config_id), force_fresh=force_fresh
+                                        )
                                         if quiz_content:
                                             st.session_state.quiz_for_review = {
                                                 "config_id": config_id,
-                                                "content": quiz_content
+                                                "content": quiz_content,
+                                                "model_name": model_name,
+                                                "duplicates": find_near_duplicates(config_id, quiz_content)
                                             }
                                             st.rerun()
 
                             with col3:
                                 if quiz_has_been_generated:
                                     if st.button("Editar", key=f"edit_{config_id}", width='stretch', help="Edita la versión más reciente de esta actividad (activa o inactiva)."):
-                                        latest_quiz_data = get_latest_quiz_for_config(config_id)
-                                        if latest_quiz_data:
+                                        latest_quiz = get_latest_quiz_for_config(config_id)
+                                        if latest_quiz:
                                             st.session_state.quiz_for_review = {
                                                 "config_id": config_id,
-                                                "content": latest_quiz_data
+                                                "content": latest_quiz["content"],
+                                                "model_name": latest_quiz["model_name"]
                                             }
                                             st.rerun()
                                         else:
@@ -809,6 +2419,8 @@ def admin_panel():
 
         with st.form("ia_settings_form"):
             current_model = get_global_setting('ia_model', DEFAULT_IA_MODEL)
+            current_fallbacks = get_model_chain()[1:]
+            current_timeout = get_attempt_timeout()
             current_prompt = get_global_setting('ia_prompt', DEFAULT_IA_PROMPT)
 
             new_model = st.text_input(
@@ -818,6 +2430,18 @@ def admin_panel():
             )
             st.caption("Modelos recomendados: `models/gemini-1.5-flash-latest` (rápido y eficiente), `models/gemini-1.5-pro-latest` (más potente).")
 
+            new_fallbacks = st.text_area(
+                "Modelos de respaldo (uno por línea, en orden)",
+                value="\n".join(current_fallbacks),
+                height=100,
+                help="Si el modelo principal supera el tiempo máximo por intento o agota su cuota, la generación continúa con el siguiente modelo de esta lista."
+            )
+            new_timeout = st.number_input(
+                "Tiempo máximo por intento (segundos)",
+                min_value=10, max_value=600, value=int(current_timeout), step=10,
+                help="Plazo de cada llamada a un modelo antes de pasar al siguiente de la cadena."
+            )
+
             new_prompt = st.text_area(
                 "Prompt de Sistema para la IA",
                 value=current_prompt,
@@ -828,6 +2452,8 @@ def admin_panel():
             submitted = st.form_submit_button("Guardar Configuración de IA", type="primary", width='stretch')
             if submitted:
                 save_global_setting('ia_model', new_model)
+                save_global_setting('ia_fallback_models', json.dumps([m.strip() for m in new_fallbacks.splitlines() if m.strip()]))
+                save_global_setting('ia_attempt_timeout', str(new_timeout))
                 save_global_setting('ia_prompt', new_prompt)
                 st.toast("¡Configuración de IA guardada! ⚙️", icon="✅")
                 st.rerun()
@@ -840,6 +2466,8 @@ def admin_panel():
             c1, c2 = st.columns(2)
             if c1.button("Sí, restaurar", type="primary"):
                 save_global_setting('ia_model', DEFAULT_IA_MODEL)
+                save_global_setting('ia_fallback_models', json.dumps(DEFAULT_IA_FALLBACK_MODELS))
+                save_global_setting('ia_attempt_timeout', str(DEFAULT_IA_ATTEMPT_TIMEOUT))
                 save_global_setting('ia_prompt', DEFAULT_IA_PROMPT)
                 del st.session_state.confirm_restore_ia
                 st.toast("Configuración de IA restaurada. 🔄", icon="✅")
@@ -848,6 +2476,28 @@ def admin_panel():
                 del st.session_state.confirm_restore_ia
                 st.rerun()
 
+        if st.button("Vaciar caché de generaciones", help="Elimina las respuestas de la IA guardadas para configuraciones y prompts idénticos."):
+            clear_generation_cache()
+            st.toast("Caché de generaciones vaciada. 🧹", icon="✅")
+
+        st.subheader("Modo de Actividad para Estudiantes", divider=True)
+        client_mode = get_global_setting('quiz_client_mode', '0') == '1'
+        new_client_mode = st.toggle(
+            "Resolver la actividad en el navegador",
+            value=client_mode,
+            help="La actividad completa se envía una sola vez y la navegación entre preguntas no recarga la página; "
+                 "sólo se contacta al servidor para guardar avances y al enviar. Recomendado con muchos estudiantes "
+                 "o conexiones lentas. El texto admite formato básico (negrita, cursiva, párrafos)."
+        )
+        if new_client_mode != client_mode:
+            save_global_setting('quiz_client_mode', '1' if new_client_mode else '0')
+            st.toast(f"Modo navegador {'activado' if new_client_mode else 'desactivado'} para los próximos intentos.", icon="✅")
+            st.rerun()
+
+        progress_error = get_progress_buffer()["last_error"]
+        if progress_error:
+            st.warning(f"Último error al guardar el avance de los intentos: {progress_error}")
+
         st.subheader("Zona de Peligro", divider=True)
         
         if st.button("Limpiar TODO el Ranking", type="secondary"):
@@ -874,6 +2524,12 @@ def admin_panel():
 if 'nombre_estudiante' not in st.session_state: st.session_state.nombre_estudiante = ""
 if 'password_correct' not in st.session_state: st.session_state.password_correct = False
 
+# Precarga única por proceso de las actividades activas (las siguientes sesiones la encuentran hecha).
+try:
+    warm_up_caches()
+except Exception as e:
+    st.warning(f"No se pudieron precargar las actividades: {e}")
+
 # --- PANELES Y PESTAÑAS ---
 tab_examen, tab_ranking, tab_admin = st.tabs(["Actividades", "Registro de participaciones", "Área del profesor"])
 
@@ -887,7 +2543,11 @@ def display_attempt_review(attempt_details):
     """Muestra la vista detallada de un intento de quiz."""
     student_name = attempt_details['student_name']
     st.header(f"Revisando la actividad de: {student_name}")
-    st.caption(f"Realizada el: {pd.to_datetime(attempt_details['timestamp']).strftime('%Y-%m-%d %H:%M')}")
+    if attempt_details.get('ts_epoch_ms') is not None:
+        realizada = datetime.fromtimestamp(attempt_details['ts_epoch_ms'] / 1000, ZoneInfo("America/Caracas"))
+        st.caption(f"Realizada el: {realizada:%Y-%m-%d %H:%M}")
+    else:
+        st.caption(f"Realizada el: {attempt_details.get('timestamp') or 'fecha desconocida'}")
     st.info("A continuación se muestra cada pregunta tal como la vio el estudiante, junto con su respuesta y la corrección.")
 
     quiz_snapshot = json.loads(attempt_details['quiz_snapshot_json'])
@@ -935,34 +2595,32 @@ def render_paginated_ranking_fragment(df_to_display, profile_name, selected_vari
     offset = (st.session_state[page_key] - 1) * page_size
     paginated_df = df_to_display.iloc[offset : offset + page_size]
 
+    # Textos de la página calculados por columnas (sin recorrer filas ni volver a interpretar fechas).
+    page_table = pd.DataFrame({
+        'Estudiante': paginated_df['student_name'],
+        'Unidad': paginated_df['variant_name'],
+        'Puntaje': paginated_df['score'].astype(str) + '/' + paginated_df['total_questions'].astype(str),
+        'Nota': paginated_df['grade'],
+        'Fecha': paginated_df['timestamp'].dt.strftime('%Y-%m-%d %H:%M'),
+    })
+    column_config = {'Nota': st.column_config.NumberColumn(format="%.2f")}
+
     if is_admin:
-        # VISTA DE TARJETAS PARA EL PROFESOR
-        for _, row in paginated_df.iterrows():
-            with st.container(border=True):
-                c1, c2, c3, c4 = st.columns([2, 1, 1, 1.2])
-                with c1:
-                    st.markdown(f"**{row['student_name']}**")
-                    st.caption(f"Unidad: {row['variant_name']}")
-                    fecha = pd.to_datetime(row['timestamp']).strftime('%d de %b, %Y - %H:%M')
-                    st.caption(fecha)
-                with c2: st.metric(label="Aciertos", value=f"{row['score']}/{row['total_questions']}")
-                with c3:
-                    grade_value = row['grade']
-                    delta_color = "normal" if grade_value >= 9.5 else "inverse"
-                    st.metric(label="Calificación", value=f"{grade_value:.2f}", delta_color=delta_color)
-                with c4:
-                    st.write("") 
-                    if st.button("Revisar Intento", key=f"review_{row['id']}", width='stretch'):
-                        st.session_state.reviewing_attempt_id = row['id']; st.rerun()
+        # VISTA DE TABLA PARA EL PROFESOR: seleccionar una fila abre la revisión del intento.
+        table_key = f"results_table_{profile_name}_{selected_variant}_{st.session_state[page_key]}"
+        selection = st.dataframe(
+            page_table, width='stretch', hide_index=True, column_config=column_config,
+            on_select="rerun", selection_mode="single-row", key=table_key
+        )
+        st.caption("Selecciona una fila para revisar el intento.")
+        selected_rows = selection.selection.rows
+        if selected_rows:
+            st.session_state.reviewing_attempt_id = int(paginated_df['id'].iloc[selected_rows[0]])
+            del st.session_state[table_key]
+            st.rerun()
     else:
         # VISTA DE TABLA PARA EL ESTUDIANTE
-        df_for_student = paginated_df.copy()
-        df_for_student.rename(columns={'student_name': 'Estudiante', 'variant_name': 'Unidad', 'grade': 'Nota', 'score': 'Aciertos', 'total_questions': 'Preguntas', 'timestamp': 'Fecha'}, inplace=True)
-        df_for_student['Fecha'] = pd.to_datetime(df_for_student['Fecha']).dt.strftime('%Y-%m-%d %H:%M')
-        df_for_student['Nota'] = df_for_student['Nota'].map('{:.2f}'.format)
-        df_for_student['Puntaje'] = df_for_student['Aciertos'].astype(str) + '/' + df_for_student['Preguntas'].astype(str)
-        display_columns = ['Estudiante', 'Unidad', 'Puntaje', 'Nota', 'Fecha']
-        st.dataframe(df_for_student[display_columns], width='stretch', hide_index=True)
+        st.dataframe(page_table, width='stretch', hide_index=True, column_config=column_config)
     
     # CONTROLES DE PAGINACIÓN DENTRO DEL FRAGMENTO
     if total_pages > 1:
@@ -978,37 +2636,25 @@ def render_paginated_ranking_fragment(df_to_display, profile_name, selected_vari
 
 @st.fragment
 def render_quiz_fragment():
-    config = st.session_state.config_actual_quiz
-    num_preguntas = config['num_preguntas']        
+    config = st.session_state.quiz_config_snapshot
+    num_preguntas = len(st.session_state.quiz_question_ids)
     st.markdown(f"#### Actividad para {st.session_state.nombre_estudiante}")        
     st.progress((st.session_state.pregunta_actual + 1) / num_preguntas)
     
     idx = st.session_state.pregunta_actual
-    q_info = st.session_state.quiz_generado[idx]
+    q_info = get_attempt_question(idx)
     st.subheader(f"Actividad {idx + 1}/{num_preguntas}")
-    st.caption(f"**Asignatura:** {config.get('asignatura', 'N/A')} ({config.get('variant_name', 'N/A')})")
+    st.caption(f"**Asignatura:** {config['asignatura'] or 'N/A'} ({config['variant_name']})")
     
-    show_feedback_enabled = config.get('show_feedback', 1) == 1
-    pregunta_a_mostrar = q_info['pregunta']
-    if not show_feedback_enabled:
-        partes = pregunta_a_mostrar.split('\n\n')
-        # Si la pregunta tiene más de un párrafo (idealmente 3),
-        # se unen los dos últimos para mostrarlos.
-        if len(partes) > 1:
-            pregunta_a_mostrar = '\n\n'.join(partes[-1:])
+    show_feedback_enabled = config['show_feedback'] == 1
+    # Sin retroalimentación se muestra sólo el enunciado (último párrafo, separado al guardar la versión).
+    pregunta_a_mostrar = q_info['pregunta'] if show_feedback_enabled else q_info['enunciado']
     st.markdown(f"{pregunta_a_mostrar}")
     
     with st.form(key=f"form_q_{idx}"):
-        opciones = q_info.get('opciones', {})
-        if isinstance(opciones, list):
-            letras_opcion = [chr(65 + i) for i in range(len(opciones))]
-            opciones_normalizadas = {}
-            for letra, texto_opcion in zip(letras_opcion, opciones):
-                texto_limpio = re.sub(r'^[A-Z][\)\.]\s*', '', str(texto_opcion)).strip()
-                opciones_normalizadas[letra] = texto_limpio
-            opciones = opciones_normalizadas
+        opciones = q_info['opciones']
         
-        resp_usr = st.radio("Respuesta:", opciones.keys(), index=None, format_func=lambda k: f"{k}: {opciones.get(k, '')}", key=f"r_{idx}", disabled=st.session_state.respuesta_enviada)
+        resp_usr = st.radio("Respuesta:", opciones.keys(), index=None, format_func=q_info['etiquetas'].get, key=f"r_{idx}", disabled=st.session_state.respuesta_enviada)
         
         is_last_question = (idx == num_preguntas - 1)
         
@@ -1019,6 +2665,7 @@ def render_quiz_fragment():
 
         if st.form_submit_button(submit_label, disabled=st.session_state.respuesta_enviada):
             st.session_state.respuestas_usuario[idx] = resp_usr
+            record_attempt_answer(st.session_state.get('attempt_id'), idx, resp_usr)
             if resp_usr == q_info.get('respuesta_correcta'):
                 st.session_state.puntaje += 1
             
@@ -1035,7 +2682,7 @@ def render_quiz_fragment():
             
     if st.session_state.respuesta_enviada:
         correcta = q_info.get('respuesta_correcta')
-        elegida = st.session_state.respuestas_usuario.get(idx)
+        elegida = st.session_state.respuestas_usuario[idx]
         
         if elegida == correcta: st.success(f"¡Correcto! La respuesta es la **{correcta}**.")
         else: st.error(f"**Incorrecto**. La respuesta correcta era **{correcta}**: {opciones.get(correcta, 'N/A')}")
@@ -1052,30 +2699,101 @@ def render_quiz_fragment():
                 st.session_state.pagina = 'resultados'
                 st.rerun()
 
+@st.fragment
+def render_quiz_client():
+    """
+    Modo navegador: envía la actividad completa al componente una sola vez (hasta que avisa
+    que la recibió) y sólo vuelve a ejecutarse al guardar avances o al enviar. Cada mensaje
+    del navegador trae únicamente las respuestas que este lado aún no ha confirmado. Sin
+    retroalimentación no se envían al navegador ni las respuestas correctas ni las
+    explicaciones; el puntaje siempre se calcula aquí.
+    """
+    config = st.session_state.quiz_config_snapshot
+    show_feedback_enabled = config['show_feedback'] == 1
+    preguntas = [get_attempt_question(i) for i in range(len(st.session_state.quiz_question_ids))]
+    attempt_id = st.session_state.get('attempt_id')
+    cargado = st.session_state.get('quiz_client_loaded') == attempt_id
+
+    st.markdown(f"#### Actividad para {st.session_state.nombre_estudiante}")
+    st.caption(f"**Asignatura:** {config['asignatura'] or 'N/A'} ({config['variant_name']})")
+    resultado = quiz_client_component(
+        preguntas=None if cargado else [
+            {"pregunta": q['pregunta'], "opciones": q['opciones'], "correcta": q['respuesta_correcta'], "explicacion": q['explicacion']}
+            if show_feedback_enabled else
+            {"pregunta": q['enunciado'], "opciones": q['opciones']}
+            for q in preguntas
+        ],
+        respuestas=st.session_state.respuestas_usuario,
+        actual=st.session_state.pregunta_actual,
+        show_feedback=show_feedback_enabled,
+        checkpoint_every=QUIZ_CLIENT_CHECKPOINT_EVERY,
+        confirmado=st.session_state.get('quiz_client_last_event', 0),
+        key=f"quiz_client_{attempt_id}",
+        default=None,
+    )
+    # El componente devuelve su último mensaje en cada rerun: sólo se procesa una vez.
+    if not resultado or resultado.get('enviado_en') == st.session_state.get('quiz_client_last_event'):
+        return
+    st.session_state.quiz_client_last_event = resultado.get('enviado_en')
+
+    evento = resultado.get('evento')
+    if evento == 'recargar':
+        # El componente se montó de nuevo sin preguntas: se le vuelven a enviar.
+        st.session_state.quiz_client_loaded = None
+        st.rerun(scope="fragment")
+    if evento == 'montado':
+        st.session_state.quiz_client_loaded = attempt_id
+
+    # Lo que llega del navegador se valida contra el índice y las opciones de cada pregunta.
+    respuestas = list(st.session_state.respuestas_usuario)
+    for idx, letra in (resultado.get('cambios') or {}).items():
+        idx = int(idx) if str(idx).isdigit() else -1
+        if 0 <= idx < len(preguntas) and letra in preguntas[idx]['opciones'] and letra != respuestas[idx]:
+            respuestas[idx] = letra
+            record_attempt_answer(attempt_id, idx, letra)
+    st.session_state.respuestas_usuario = respuestas
+    st.session_state.pregunta_actual = min(max(int(resultado.get('actual') or 0), 0), len(preguntas) - 1)
+    if evento == 'enviar':
+        st.session_state.puntaje = sum(1 for r, q in zip(st.session_state.respuestas_usuario, preguntas) if r == q['respuesta_correcta'])
+        st.session_state.pagina = 'resultados'
+        st.rerun()
+
 
 # --- BLOQUE 'with tab_ranking:' CON VISTAS CONDICIONALES ---
 
+# Las funciones siguientes reciben el DataFrame como `_df` (Streamlit no lo hashea) y se
+# indexan por `data_version`, una tupla barata que cambia cuando cambian los datos.
+
+def results_data_version(profile_name, since_ms, results_df, variants=()):
+    """
+    Versión de los resultados cargados: generación del almacén, perfil, periodo, último ID,
+    número de filas y unidades incluidas. La generación distingue los datos anteriores y
+    posteriores a un borrado total, tras el cual los IDs vuelven a empezar.
+    """
+    last_id = int(results_df['id'].max()) if not results_df.empty else 0
+    generation = get_results_store()["generation"]
+    return (generation, profile_name, since_ms, last_id, len(results_df), tuple(variants))
+
+
 @st.cache_data
-def convert_df_to_csv(df):
+def convert_df_to_csv(data_version, _df):
     """Convierte un DataFrame de pandas a un archivo CSV codificado en UTF-8."""
-    return df.to_csv(index=True).encode('utf-8')
+    return _df.to_csv(index=True).encode('utf-8')
 
 
 @st.cache_data
-def calculate_gradebook(df, policy):
+def calculate_gradebook(data_version, policy, _df):
     """
     Toma el DataFrame de resultados y la política de calificación,
     y devuelve el DataFrame procesado para el libro de calificaciones.
+    'timestamp' ya llega como fecha desde get_results_by_profile_as_df.
     """
-    processed_df = df.copy()
-    processed_df['timestamp'] = pd.to_datetime(processed_df['timestamp'])
-
     if policy == "Calificación más reciente":
-        final_grades_df = processed_df.sort_values('timestamp').groupby(['student_name', 'variant_name']).last().reset_index()
+        final_grades_df = _df.sort_values('timestamp').groupby(['student_name', 'variant_name']).last().reset_index()
     elif policy == "Promedio de calificaciones":
-        final_grades_df = processed_df.groupby(['student_name', 'variant_name'])['grade'].mean().reset_index()
+        final_grades_df = _df.groupby(['student_name', 'variant_name'])['grade'].mean().reset_index()
     else:  # "Calificación más alta" por defecto
-        final_grades_df = processed_df.sort_values('grade').groupby(['student_name', 'variant_name']).last().reset_index()
+        final_grades_df = _df.sort_values('grade').groupby(['student_name', 'variant_name']).last().reset_index()
 
     gradebook_view = final_grades_df.pivot_table(
         index='student_name', columns='variant_name', values='grade'
@@ -1083,6 +2801,138 @@ def calculate_gradebook(df, policy):
     return gradebook_view
 
 
+def render_export_progress(job_id):
+    """Avance de un trabajo en curso. Se ejecuta como fragmento cada 2 segundos; al terminar, un rerun muestra el resultado."""
+    job = get_export_jobs()["jobs"].get(job_id)
+    if job is None or job["status"] != "running":
+        st.rerun()
+    st.info(f"Exportando... {job['rows']} filas escritas.")
+
+def render_export_panel(profile_name, evaluative_variants):
+    """Exportación por bloques del registro de intentos o del libro de calificaciones (sólo profesor)."""
+    with st.expander("📦 Exportar datos (CSV, XLSX, Parquet)"):
+        dataset = st.radio("Datos", ["Registro de intentos", "Libro de calificaciones"], horizontal=True, key=f"export_dataset_{profile_name}")
+        fmt = st.radio("Formato", list(EXPORT_FORMATS), horizontal=True, key=f"export_format_{profile_name}")
+        if dataset == "Registro de intentos":
+            columns = st.multiselect(
+                "Columnas", list(EXPORT_ATTEMPT_COLUMNS), default=[c for c in EXPORT_ATTEMPT_COLUMNS if not c.endswith('_json')],
+                format_func=lambda c: EXPORT_ATTEMPT_COLUMNS[c][0], key=f"export_columns_{profile_name}"
+            )
+        else:
+            policy = st.selectbox(
+                "Política de Calificación:", list(GRADE_POLICY_SQL), key=f"export_policy_{profile_name}"
+            )
+        date_range = st.date_input(
+            "Fechas (desde, hasta)", value=(), key=f"export_dates_{profile_name}",
+            help="Déjalo vacío para exportar todo el registro; una sola fecha exporta ese día."
+        )
+
+        if st.button("Iniciar exportación", key=f"export_start_{profile_name}"):
+            tz = ZoneInfo("America/Caracas")
+            since_ms, until_ms = 0, 2**62
+            if date_range:
+                # Mientras se elige el rango el widget devuelve sólo la fecha inicial: se toma como un único día.
+                desde, hasta = date_range[0], date_range[-1]
+                since_ms = int(datetime.combine(desde, datetime.min.time(), tz).timestamp() * 1000)
+                until_ms = int(datetime.combine(hasta + timedelta(days=1), datetime.min.time(), tz).timestamp() * 1000) - 1
+            spec = {"profile_name": profile_name, "format": fmt, "since_ms": since_ms, "until_ms": until_ms}
+            if dataset == "Registro de intentos":
+                spec.update(dataset="attempts", columns=columns)
+            else:
+                spec.update(dataset="gradebook", policy=policy, variants=evaluative_variants)
+            if spec["dataset"] == "attempts" and not columns:
+                st.warning("Selecciona al menos una columna.")
+            elif spec["dataset"] == "gradebook" and not evaluative_variants:
+                st.warning("Esta asignatura no tiene unidades evaluativas.")
+            else:
+                st.session_state.export_job_id = start_export_job(spec)
+
+        job_id = st.session_state.get('export_job_id')
+        job = get_export_jobs()["jobs"].get(job_id) if job_id else None
+        if job is None:
+            return
+        if job["status"] == "running":
+            st.fragment(run_every=2)(render_export_progress)(job_id)
+        elif job["status"] == "error":
+            st.error(f"La exportación falló: {job['error']}")
+        else:
+            st.success(f"Exportación lista: {job['rows']} filas.")
+            try:
+                with open(job["path"], "rb") as f:
+                    st.download_button("📥 Descargar archivo", data=f, file_name=job["file_name"], mime=job["mime"], key=f"download_{job_id}")
+            except FileNotFoundError:
+                # Otro profesor lanzó suficientes exportaciones como para descartar esta.
+                st.info("El archivo ya no está disponible; vuelve a iniciar la exportación.")
+
+RESULTS_AUTO_REFRESH_SECONDS = 10
+
+def render_profile_results(profile_name, auto_refresh=False):
+    """
+    Libro de calificaciones y registro de intentos de una sola asignatura. Se ejecuta como
+    fragmento: sólo se consulta la asignatura elegida y los filtros internos vuelven a
+    ejecutar únicamente esta parte. Con `auto_refresh` trae en cada ejecución sólo los
+    intentos nuevos.
+    """
+    if auto_refresh:
+        mark_results_stale(profile_name)
+    period_days = {"Todo el registro": None, "Últimos 7 días": 7, "Últimos 30 días": 30}
+    period = st.selectbox("Periodo:", list(period_days), key=f"results_period_{profile_name}")
+    since_ms = None
+    if period_days[period]:
+        # Se cuenta desde la medianoche para que la clave de la caché no cambie en cada rerun.
+        today = datetime.now(ZoneInfo("America/Caracas")).replace(hour=0, minute=0, second=0, microsecond=0)
+        since_ms = int((today - timedelta(days=period_days[period])).timestamp() * 1000)
+    full_results_df = get_results_by_profile_as_df(profile_name, since_ms)
+
+    # --- VISTA DE LIBRO DE CALIFICACIONES (SÓLO PROFESOR) ---
+    if st.session_state.password_correct:
+        st.subheader("Libro de Calificaciones (Solo Unidades Evaluativas)", divider=True)
+        st.caption("Esta vista solo incluye los resultados de las unidades configuradas sin retroalimentación inmediata.")
+
+        configs_df = get_configs_for_profile_as_df(profile_name)
+        evaluative_variants = configs_df[configs_df['show_feedback'] == 0]['variant_name'].tolist()
+        gradebook_data_df = full_results_df[full_results_df['variant_name'].isin(evaluative_variants)]
+
+        if gradebook_data_df.empty:
+            st.info("No hay resultados de unidades evaluativas para mostrar en el libro de calificaciones.")
+        else:
+            policy = st.selectbox(
+                "Política de Calificación:",
+                options=["Calificación más alta", "Calificación más reciente", "Promedio de calificaciones"],
+                key=f"grading_policy_{profile_name}",
+                help="Define cómo se consolidan múltiples intentos de un mismo estudiante en una sola nota."
+            )
+
+            data_version = results_data_version(profile_name, since_ms, full_results_df, evaluative_variants)
+            gradebook_view = calculate_gradebook(data_version, policy, gradebook_data_df)
+
+            st.dataframe(gradebook_view.style.format("{:.2f}", na_rep='-').highlight_null(props="color: #666;"), width='stretch')
+
+            csv_data = convert_df_to_csv((data_version, policy), gradebook_view)
+            st.download_button(
+               label="📥 Descargar como CSV",
+               data=csv_data,
+               file_name=f'calificaciones_evaluativas_{profile_name.replace(" ", "_")}.csv',
+               mime='text/csv',
+            )
+
+        render_export_panel(profile_name, evaluative_variants)
+
+        st.subheader("Registro de Todos los Intentos (Auditoría)", divider=True)
+
+
+    # --- VISTA DE INTENTOS INDIVIDUALES (FRAGMENTADA) ---
+    variants_with_results = sorted(full_results_df['variant_name'].unique().tolist())
+    all_variants_option = "-- Todas las Unidades --"
+    selected_variant = st.selectbox("Filtrar por unidad: ", [all_variants_option] + variants_with_results, key=f"variant_filter_{profile_name}")
+    df_to_display = full_results_df if selected_variant == all_variants_option else full_results_df[full_results_df['variant_name'] == selected_variant]
+
+    if df_to_display.empty:
+        st.info("No hay registros que coincidan con el filtro seleccionado.")
+    else:
+        render_paginated_ranking_fragment(df_to_display, profile_name, selected_variant, is_admin=st.session_state.password_correct)
+
+
 with tab_ranking:
     # 1. LÓGICA PARA MOSTRAR UNA REVISIÓN INDIVIDUAL (SÓLO PROFESOR)
     if 'reviewing_attempt_id' in st.session_state and st.session_state.password_correct:
@@ -1102,64 +2952,27 @@ with tab_ranking:
             st.subheader("Participaciones por asignatura", anchor=False)
         with col_button:
             if st.button("Refrescar", width='stretch', help="Vuelve a cargar los resultados desde la base de datos y resetea cualquier quiz activo."):
-            	reset_quiz_state(); get_results_by_profile_as_df.clear(); st.toast("¡Registro actualizado!"); st.rerun()
+            	mark_results_stale(); get_profiles_with_results.clear(); st.toast("¡Registro actualizado!"); reset_quiz_state()
 
-        client = get_db_client(); rs = client.execute("SELECT DISTINCT profile_name FROM quiz_results ORDER BY profile_name");
-        profiles_with_results = [row[0] for row in rs.rows]
+        profiles_with_results = get_profiles_with_results()
 
         if not profiles_with_results:
             st.info("Aún no hay resultados para mostrar.")
         else:
-            profile_tabs = st.tabs(profiles_with_results)
-            for i, profile_name in enumerate(profiles_with_results):
-                with profile_tabs[i]:
-                    full_results_df = get_results_by_profile_as_df(profile_name)
-
-                    # --- VISTA DE LIBRO DE CALIFICACIONES (SÓLO PROFESOR) ---
-                    if st.session_state.password_correct:
-                        st.subheader("Libro de Calificaciones (Solo Unidades Evaluativas)", divider=True)
-                        st.caption("Esta vista solo incluye los resultados de las unidades configuradas sin retroalimentación inmediata.")
-                        
-                        configs_df = get_configs_for_profile_as_df(profile_name)
-                        evaluative_variants = configs_df[configs_df['show_feedback'] == 0]['variant_name'].tolist()
-                        gradebook_data_df = full_results_df[full_results_df['variant_name'].isin(evaluative_variants)]
-
-                        if gradebook_data_df.empty:
-                            st.info("No hay resultados de unidades evaluativas para mostrar en el libro de calificaciones.")
-                        else:
-                            policy = st.selectbox(
-                                "Política de Calificación:",
-                                options=["Calificación más alta", "Calificación más reciente", "Promedio de calificaciones"],
-                                key=f"grading_policy_{profile_name}",
-                                help="Define cómo se consolidan múltiples intentos de un mismo estudiante en una sola nota."
-                            )
-                            
-                            gradebook_view = calculate_gradebook(gradebook_data_df, policy)
-
-                            st.dataframe(gradebook_view.style.format("{:.2f}", na_rep='-').highlight_null(props="color: #666;"), width='stretch')
-                            
-                            csv_data = convert_df_to_csv(gradebook_view)
-                            st.download_button(
-                               label="📥 Descargar como CSV",
-                               data=csv_data,
-                               file_name=f'calificaciones_evaluativas_{profile_name.replace(" ", "_")}.csv',
-                               mime='text/csv',
-                            )
-                        
-                        st.subheader("Registro de Todos los Intentos (Auditoría)", divider=True)
-
-
-                    # --- VISTA DE INTENTOS INDIVIDUALES (FRAGMENTADA) ---
-                    variants_with_results = sorted(full_results_df['variant_name'].unique().tolist())
-                    all_variants_option = "-- Todas las Unidades --"
-                    selected_variant = st.selectbox("Filtrar por unidad: ", [all_variants_option] + variants_with_results, key=f"variant_filter_{profile_name}")
-                    df_to_display = full_results_df if selected_variant == all_variants_option else full_results_df[full_results_df['variant_name'] == selected_variant]
-                    
-                    if df_to_display.empty:
-                        st.info("No hay registros que coincidan con el filtro seleccionado.")
-                    else:
-                        render_paginated_ranking_fragment(df_to_display, profile_name, selected_variant, is_admin=st.session_state.password_correct)
-
+            # En lugar de st.tabs (que ejecuta el contenido de todas las pestañas), un selector:
+            # sólo se cargan y dibujan los datos de la asignatura elegida.
+            # Una asignatura elegida antes que ya no tiene resultados (p. ej. tras limpiar el ranking) se olvida.
+            if st.session_state.get("ranking_profile_select") not in (None, *profiles_with_results):
+                del st.session_state["ranking_profile_select"]
+            selected_profile = st.segmented_control(
+                "Asignatura", profiles_with_results, default=profiles_with_results[0],
+                key="ranking_profile_select", label_visibility="collapsed"
+            ) or profiles_with_results[0]
+            auto_refresh = st.session_state.password_correct and st.toggle(
+                f"Actualizar automáticamente cada {RESULTS_AUTO_REFRESH_SECONDS} s", key="results_auto_refresh",
+                help="Útil para seguir una actividad en curso: cada actualización sólo trae los intentos nuevos."
+            )
+            st.fragment(run_every=RESULTS_AUTO_REFRESH_SECONDS if auto_refresh else None)(render_profile_results)(selected_profile, auto_refresh)
 
 with tab_examen:	
     # 1. INICIALIZAR ESTADO DE SESIÓN PARA TOKEN Y USUARIO
@@ -1201,8 +3014,34 @@ with tab_examen:
             
             student_identifier = f"{user_info.get('name', 'N/A')}"
             st.session_state.nombre_estudiante = student_identifier 
+            student_email = user_info.get('email') or user_info.get('sub') or student_identifier
 
             st.subheader(f"Bienvenido, {user_info.get('name', 'Estudiante')}", divider=True)
+
+            # Al iniciar sesión se busca (una vez) un intento interrumpido para ofrecer retomarlo.
+            if 'resume_checked' not in st.session_state:
+                st.session_state.resume_checked = True
+                st.session_state.open_attempt = get_open_attempt(student_email)
+            open_attempt = st.session_state.get('open_attempt')
+            if open_attempt and not open_attempt['config']:
+                legacy_config = load_config_from_db(open_attempt['config_id'])
+                open_attempt['config'] = config_snapshot(legacy_config) if legacy_config else None
+            open_config = open_attempt['config'] if open_attempt else None
+            if open_attempt and open_config and len(get_shared_quiz_version(open_attempt['version_id'])):
+                respondidas = sum(1 for r in open_attempt['respuestas'] if r is not None)
+                with st.container(border=True):
+                    st.info(
+                        f"Tienes una actividad sin terminar: **{open_config['variant_name']}** "
+                        f"({respondidas} de {len(open_attempt['question_ids'])} respuestas guardadas)."
+                    )
+                    c1, c2 = st.columns(2)
+                    if c1.button("Continuar donde la dejé", type="primary", width='stretch'):
+                        resume_attempt(open_attempt)
+                        st.rerun()
+                    if c2.button("Descartarla", width='stretch'):
+                        close_attempt_progress(open_attempt['attempt_id'])
+                        st.session_state.open_attempt = None
+                        st.rerun()
             
             global_message = get_global_message()
             if global_message:
@@ -1264,29 +3103,48 @@ with tab_examen:
 
                 if st.button("Iniciar Actividad", type="primary", disabled=not is_selected_variant_active):
                     if selected_config_id:
-                        config = load_config_from_db(selected_config_id)
-                        st.session_state.config_actual_quiz = config
+                        admission_placeholder = st.empty()
+                        acquire_start_slot(admission_placeholder)
+                        try:
+                            config = load_config_from_db(selected_config_id)
                         
-                        with st.spinner(f"¡Mucha suerte, {user_info.get('name')}! Preparando tu actividad..."):
-                            quiz_data = get_active_quiz_for_config(selected_config_id)
+                            with st.spinner(f"¡Mucha suerte, {user_info.get('name')}! Preparando tu actividad..."):
+                                active_version = get_active_quiz_version(selected_config_id)
                             
-                            if quiz_data:
-                                if not config.get('show_feedback', 1): random.shuffle(quiz_data)
-                                
-                                num_a_presentar = config['num_preguntas']
-                                quiz_subset = quiz_data[:num_a_presentar]
-                                
-                                shuffled_quiz = [shuffle_question_options(q) for q in quiz_subset]
-                                st.session_state.quiz_generado = shuffled_quiz
+                                question_ids = ()
+                                if active_version:
+                                    # Variante precalculada al activar, asignada por turnos: intentos consecutivos
+                                    # (estudiantes vecinos) reciben órdenes distintos.
+                                    question_ids, option_orders = pick_attempt_variant(active_version, config['num_preguntas'], int(config.get('show_feedback', 1)))
+                            
+                                if question_ids:
+                                    # La sesión sólo guarda referencias a la versión compartida e inmutable:
+                                    # los IDs elegidos y una tupla de índices de opciones por pregunta.
+                                    st.session_state.quiz_version_id = active_version['version_id']
+                                    st.session_state.quiz_config_id = selected_config_id
+                                    st.session_state.quiz_config_snapshot = config_snapshot(config)
+                                    st.session_state.quiz_question_ids = list(question_ids)
+                                    st.session_state.quiz_option_orders = list(option_orders)
+                                    # El modo se fija al iniciar para que un cambio del ajuste no afecte intentos en curso.
+                                    st.session_state.quiz_client_mode = get_global_setting('quiz_client_mode', '0') == '1'
+                                    st.session_state.attempt_id = uuid.uuid4().hex
+                                    st.session_state.open_attempt = None
+                                    start_attempt_progress(
+                                        st.session_state.attempt_id, student_email, selected_config_id, active_version['version_id'],
+                                        question_ids, option_orders, st.session_state.quiz_client_mode,
+                                        st.session_state.quiz_config_snapshot
+                                    )
                                 
-                                st.session_state.pagina = 'quiz'
-                                st.session_state.pregunta_actual = 0
-                                st.session_state.respuestas_usuario = {}
-                                st.session_state.puntaje = 0
-                                st.session_state.respuesta_enviada = False
-                                st.rerun()
-                            else:
-                                st.error("Lo sentimos, esta actividad no está activada.")
+                                    st.session_state.pagina = 'quiz'
+                                    st.session_state.pregunta_actual = 0
+                                    st.session_state.respuestas_usuario = [None] * len(question_ids)
+                                    st.session_state.puntaje = 0
+                                    st.session_state.respuesta_enviada = False
+                                    st.rerun()
+                                else:
+                                    st.error("Lo sentimos, esta actividad no está activada o no tiene preguntas disponibles.")
+                        finally:
+                            release_start_slot()
                     else:
                         st.warning("Debes seleccionar una asignatura y una unidad para continuar.")
                 
@@ -1303,14 +3161,17 @@ with tab_examen:
 
         # VISTA DEL QUIZ: MOSTRAR PREGUNTAS EN FRAGMENTO
         elif st.session_state.pagina == 'quiz':
-            render_quiz_fragment()
+            if st.session_state.get('quiz_client_mode'):
+                render_quiz_client()
+            else:
+                render_quiz_fragment()
                         
         # VISTA DE RESULTADOS FINALES
         elif st.session_state.pagina == 'resultados':
             st.header("Resultados Finales")
             puntaje = st.session_state.puntaje
-            config = st.session_state.config_actual_quiz
-            num_preguntas = len(st.session_state.quiz_generado)
+            config = st.session_state.quiz_config_snapshot
+            num_preguntas = len(st.session_state.quiz_question_ids)
             calif = (puntaje / num_preguntas) * 19 if num_preguntas > 0 else 0
             
             if 'results_saved' not in st.session_state:
@@ -1321,9 +3182,13 @@ with tab_examen:
                     score=puntaje,
                     total_questions=num_preguntas,
                     grade=calif,
-                    quiz_snapshot=st.session_state.quiz_generado,
-                    student_answers=st.session_state.respuestas_usuario
+                    quiz_snapshot=[
+                        {k: q[k] for k in ('pregunta', 'opciones', 'respuesta_correcta', 'explicacion')}
+                        for q in (get_attempt_question(i) for i in range(num_preguntas))
+                    ],
+                    student_answers=dict(enumerate(st.session_state.respuestas_usuario))
                 )
+                close_attempt_progress(st.session_state.get('attempt_id'))
                 st.session_state.results_saved = True
                 st.toast("¡Tu resultado ha sido guardado en el registro de participaciones!")
 